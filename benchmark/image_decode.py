@@ -0,0 +1,107 @@
+""" Memory and time cost of creating a thumbnail of a large phone photo,
+decoding it at full resolution (before) or at reduced scale (after).
+
+    python benchmark/image_decode.py --width 8000 --height 6000 --size 256
+
+The photo is a synthetic JPEG with an EXIF orientation, like most phone
+photos. Every case runs in a fresh process and reports that process' peak
+RSS, `idle` is the peak RSS of a process that only imported the modules.
+"""
+import os
+import sys
+import time
+import argparse
+import resource
+import tempfile
+import multiprocessing
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from PIL import Image
+
+from seafile_thumbnail import settings, thumbnail as thumbnail_module
+from seafile_thumbnail.thumbnail import Thumbnail
+from seafile_thumbnail.storage import LocalStorage
+from seafile_thumbnail.thumbnail_index import ThumbnailIndex
+
+
+def create_photo(path, width, height):
+    # upscaled noise: photo like detail, but compresses like a photo too
+    image = Image.effect_noise((width // 10, height // 10), 64).convert('RGB')
+    image = image.resize((width, height), Image.Resampling.BICUBIC)
+    exif = Image.Exif()
+    exif[0x0112] = 6  # rotated 90 CW, portrait phone photo
+    image.save(path, 'JPEG', quality=90, exif=exif)
+
+
+def full_decode(photo, thumbnail_file, size):
+    # the pipeline before reduced scale decoding
+    thumbnail = Thumbnail.__new__(Thumbnail)
+    image = Image.open(photo)
+    if image.mode not in ["1", "L", "P", "RGB"]:
+        image = image.convert("RGB")
+    image = thumbnail.get_rotated_image(image)
+    image.thumbnail((size, size), Image.Resampling.LANCZOS)
+    byte_io = BytesIO()
+    image.save(byte_io, 'jpeg')
+    with open(thumbnail_file, 'wb') as f:
+        f.write(byte_io.getvalue())
+
+
+def reduced_decode(photo, thumbnail_file, size):
+    # cache the thumbnails next to thumbnail_file
+    settings.THUMBNAIL_DIR = os.path.dirname(thumbnail_file)
+    thumbnail_module.thumbnail_storage = LocalStorage(ThumbnailIndex(thumbnail_file + '.db',
+                                                                     thumbnail_file + '.lock'))
+    thumbnail = Thumbnail.__new__(Thumbnail)
+    thumbnail.file_id = os.path.basename(thumbnail_file)
+    thumbnail._create_thumbnail_common(photo, size)
+
+
+def idle(photo, thumbnail_file, size):
+    pass
+
+
+def run_case(func, photo, thumbnail_file, size, result):
+    t1 = time.perf_counter()
+    func(photo, thumbnail_file, size)
+    t2 = time.perf_counter()
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KB on linux
+    result.put((t2 - t1, max_rss / 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=8000)
+    parser.add_argument('--height', type=int, default=6000)
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        photo = os.path.join(tmp_dir, 'photo.jpg')
+        # in its own process too, peak rss survives exec into the children
+        p = ctx.Process(target=create_photo, args=(photo, args.width, args.height))
+        p.start()
+        p.join()
+        print('photo: %sx%s, %.1f MB, thumbnail size %s' % (
+            args.width, args.height, os.path.getsize(photo) / 1024 ** 2, args.size))
+
+        for func in (idle, full_decode, reduced_decode):
+            times, rss = [], []
+            for i in range(args.repeat):
+                result = ctx.Queue()
+                p = ctx.Process(target=run_case, args=(
+                    func, photo, os.path.join(tmp_dir, func.__name__), args.size, result))
+                p.start()
+                cost, max_rss = result.get()
+                p.join()
+                times.append(cost)
+                rss.append(max_rss)
+            print('%-15s time %7.3fs  peak rss %7.1f MB' % (func.__name__, min(times), max(rss)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+""" A burst of requests for one missing thumbnail sent to every node of a
+local cluster, in proxy and redirect mode: the thumbnail is generated once,
+by the node owning its file id, however many nodes are asked.
+
+    python benchmark/peers.py --nodes 3 --requests 60
+
+Each node is this script run with --node, on its own port with its own
+THUMBNAIL_DIR and THUMBNAIL_PEER_SELF. Nothing is read from seahub or the
+fileserver: the request path stands for the file, and generating a
+thumbnail takes --generate-time seconds and appends the node's port to a
+log shared by the nodes, which is counted afterwards.
+"""
+import os
+import sys
+import time
+import socket
+import hashlib
+import argparse
+import tempfile
+import subprocess
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+REPO_ID = '12345678-1234-1234-1234-123456789012'
+SIZE = 256
+
+
+def run_node(args):
+    from seafile_thumbnail import settings
+    settings.THUMBNAIL_DIR = args.root
+    settings.THUMBNAIL_INDEX_PATH = os.path.join(args.root, '.thumbnail_index.db')
+    settings.THUMBNAIL_PEERS = args.peers.split(',')
+    settings.THUMBNAIL_PEER_SELF = 'http://127.0.0.1:%s' % args.node
+    settings.THUMBNAIL_PEER_MODE = args.mode
+    settings.ENABLE_THUMBNAIL_CACHE_GC = False
+
+    import uvicorn
+    import main
+    from seafile_thumbnail.storage import thumbnail_storage
+
+    class ThumbnailSerializer(object):
+        # the request path stands for the file, no session or seahub lookup
+        def __init__(self, request):
+            size, path = request.url.split('/', 3)[2:]
+            file_id = hashlib.sha1(path.encode('utf-8')).hexdigest()
+            self.thumbnail_info = {
+                'repo_id': REPO_ID, 'file_path': path, 'file_name': os.path.basename(path),
+                'size': size, 'file_ext': 'jpg', 'file_type': 'Image', 'file_id': file_id,
+                'etag': '"%s"' % file_id, 'last_modified': 'Thu, 01 Jan 1970 00:00:00 GMT',
+            }
+
+    def generate_thumbnail(info):
+        time.sleep(args.generate_time)
+        thumbnail = ('%s@%s' % (info['file_path'], args.node)).encode('utf-8')
+        thumbnail_storage.write(info['file_id'], int(info['size']), thumbnail)
+        with open(args.log, 'a') as f:
+            f.write('%s\n' % args.node)
+        return thumbnail
+
+    main.ThumbnailSerializer = ThumbnailSerializer
+    main.generate_thumbnail = generate_thumbnail
+    # generate_thumbnail above can not be sent to a spawned process
+    main.render_stage.executor_factory = ThreadPoolExecutor
+    uvicorn.run(main.app, host='127.0.0.1', port=args.node, log_level='warning')
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+def get(url):
+    # redirects are followed
+    try:
+        with urllib.request.urlopen(url, timeout=60) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def run_burst(tmp_dir, mode, args):
+    ports = [get_free_port() for i in range(args.nodes)]
+    nodes = ['http://127.0.0.1:%s' % port for port in ports]
+    log = os.path.join(tmp_dir, '%s.log' % mode)
+    open(log, 'w').close()
+    processes = [subprocess.Popen([
+        sys.executable, os.path.abspath(__file__), '--node', str(port), '--peers', ','.join(nodes),
+        '--mode', mode, '--root', os.path.join(tmp_dir, '%s-%s' % (mode, port)), '--log', log,
+        '--generate-time', str(args.generate_time),
+    ]) for port in ports]
+    try:
+        for node in nodes:
+            wait_for(node + '/ping')
+
+        path = 'burst-%s.jpg' % mode
+        urls = ['%s/thumbnail/%s/%s/%s' % (nodes[i % len(nodes)], REPO_ID, SIZE, path)
+                for i in range(args.requests)]
+        t1 = time.perf_counter()
+        with ThreadPoolExecutor(args.requests) as executor:
+            results = list(executor.map(get, urls))
+        t2 = time.perf_counter()
+    finally:
+        for p in processes:
+            p.terminate()
+        for p in processes:
+            p.wait()
+
+    with open(log) as f:
+        generated_by = f.read().split()
+    statuses = sorted(set(status for status, body in results))
+    bodies = set(body for status, body in results)
+    print('%-8s nodes %s  requests %4d  time %6.3fs  statuses %s  bodies %s  generated %s (by %s)' % (
+        mode, args.nodes, args.requests, t2 - t1, statuses, len(bodies), len(generated_by),
+        ', '.join(generated_by) or '-'))
+    return statuses == [200] and len(bodies) == 1 and len(generated_by) == 1
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--requests', type=int, default=60)
+    parser.add_argument('--generate-time', type=float, default=1.0)
+    # a node of the cluster, started by the benchmark
+    parser.add_argument('--node', type=int)
+    parser.add_argument('--peers')
+    parser.add_argument('--mode')
+    parser.add_argument('--root')
+    parser.add_argument('--log')
+    args = parser.parse_args()
+
+    if args.node:
+        run_node(args)
+        return
+
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for mode in ('proxy', 'redirect'):
+            ok = run_burst(tmp_dir, mode, args) and ok
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+""" Time, bytes read and memory cost of creating a thumbnail of a large
+layered PSD served over HTTP, downloading and compositing it with
+psd_tools (before), or reading the embedded preview or the reduced
+composite with range requests (after).
+
+    python benchmark/psd_preview.py --width 6000 --height 4000 --layers 8 --size 256
+
+The PSD is created with psd_tools, with a JPEG preview resource of
+--preview-size pixels like Photoshop writes. A thumbnail not larger than
+the preview is made from the preview, larger ones from the composite.
+Every case runs in a fresh process and reports that process' peak RSS.
+"""
+import os
+import sys
+import time
+import struct
+import argparse
+import resource
+import tempfile
+import threading
+import http.server
+import multiprocessing
+import urllib.request
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from PIL import Image
+
+from video_frame import RangeHandler
+
+
+def create_layer(width, height, seed):
+    # smooth shapes with some noise, compresses like a design file
+    image = Image.effect_noise((width // 50, height // 50), 40 + seed).convert('RGB')
+    image = image.resize((width, height), Image.Resampling.BICUBIC)
+    return image
+
+
+def create_psd(path, width, height, layers, preview_size):
+    from psd_tools import PSDImage
+    from psd_tools.api.layers import PixelLayer
+    from psd_tools.constants import Resource
+    from psd_tools.psd.image_resources import ImageResource
+
+    composite = create_layer(width, height, 0)
+    psd = PSDImage.frompil(composite)
+    for i in range(layers):
+        psd.append(PixelLayer.frompil(create_layer(width, height, i + 1), psd))
+
+    preview = composite.copy()
+    preview.thumbnail((preview_size, preview_size))
+    jpeg = BytesIO()
+    preview.save(jpeg, 'JPEG')
+    jpeg = jpeg.getvalue()
+    width_bytes = (preview.width * 24 + 31) // 32 * 4
+    header = struct.pack('>6I2H', 1, preview.width, preview.height, width_bytes,
+                         width_bytes * preview.height, len(jpeg), 24, 1)
+    key = Resource.THUMBNAIL_RESOURCE
+    psd.image_resources[key] = ImageResource(key=key, data=header + jpeg)
+    psd.save(path)
+
+
+def download_and_composite(url, thumbnail, size, tmp_dir):
+    # the pipeline before: download, psd_tools composite, PNG on disk
+    from psd_tools import PSDImage
+    tmp_file = os.path.join(tmp_dir, 'downloaded.psd')
+    tmp_img_path = os.path.join(tmp_dir, 'composite.png')
+    urllib.request.urlretrieve(url, tmp_file)
+    PSDImage.open(tmp_file).topil().save(tmp_img_path)
+    os.unlink(tmp_file)
+    thumbnail._create_thumbnail_common(tmp_img_path, size)
+    os.unlink(tmp_img_path)
+
+
+def range_requests(url, thumbnail, size, tmp_dir):
+    repo = type('Repo', (object,), {'id': 'repo'})
+    thumbnail.create_psd_thumbnails(repo, thumbnail.file_id, 'design.psd', size,
+                                    os.path.getsize(RangeHandler.video))
+
+
+def run_case(func, psd, size, tmp_dir, result):
+    from seafile_thumbnail import settings, thumbnail as thumbnail_module
+    from seafile_thumbnail.fileserver import FileServerClient
+    from seafile_thumbnail.storage import LocalStorage
+    from seafile_thumbnail.thumbnail_index import ThumbnailIndex
+
+    settings.THUMBNAIL_DIR = tmp_dir
+    thumbnail_module.thumbnail_storage = LocalStorage(ThumbnailIndex(os.path.join(tmp_dir, 'index.db'),
+                                                                     os.path.join(tmp_dir, '.gc.lock')))
+    RangeHandler.video = psd
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%s/files/token/design.psd' % server.server_address[1]
+    thumbnail_module.fileserver = FileServerClient(url, 4, 30, 0)
+    thumbnail_module.get_inner_path = lambda repo_id, file_id, file_name: url
+
+    thumbnail = thumbnail_module.Thumbnail.__new__(thumbnail_module.Thumbnail)
+    thumbnail.file_id = func.__name__
+    thumbnail.file_name = 'design.psd'
+    t1 = time.perf_counter()
+    func(url, thumbnail, size, tmp_dir)
+    t2 = time.perf_counter()
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KB on linux
+    result.put((t2 - t1, RangeHandler.bytes_sent, max_rss / 1024))
+    server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=6000)
+    parser.add_argument('--height', type=int, default=4000)
+    parser.add_argument('--layers', type=int, default=8)
+    parser.add_argument('--preview-size', type=int, default=160)
+    parser.add_argument('--size', type=int, action='append')
+    args = parser.parse_args()
+    sizes = args.size or [128, 1024]
+
+    ctx = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        psd = os.path.join(tmp_dir, 'design.psd')
+        # in its own process too, peak rss survives exec into the children
+        p = ctx.Process(target=create_psd, args=(
+            psd, args.width, args.height, args.layers, args.preview_size))
+        p.start()
+        p.join()
+        print('psd: %sx%s, %s layers, %.1f MB, preview %spx' % (
+            args.width, args.height, args.layers, os.path.getsize(psd) / 1024 ** 2, args.preview_size))
+
+        for size in sizes:
+            for func in (download_and_composite, range_requests):
+                case_dir = os.path.join(tmp_dir, '%s-%s' % (func.__name__, size))
+                os.mkdir(case_dir)
+                result = ctx.Queue()
+                p = ctx.Process(target=run_case, args=(func, psd, size, case_dir, result))
+                p.start()
+                cost, bytes_read, max_rss = result.get()
+                p.join()
+                print('size %-5s %-25s time %7.3fs  read %8.2f MB  peak rss %7.1f MB' % (
+                    size, func.__name__, cost, bytes_read / 1024 ** 2, max_rss))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+""" Round trip of thumbnails through the s3 shared storage: written by one
+node, copied from s3 by another one, looked up while missing, and deleted.
+
+    python benchmark/s3_storage.py --count 200
+    python benchmark/s3_storage.py --endpoint-url http://127.0.0.1:9000 --bucket thumbnails \
+        --access-key minioadmin --secret-key minioadmin
+
+Without --endpoint-url a moto server is started locally (pip install
+'moto[server]'). Each node is a TieredStorage with its own THUMBNAIL_DIR
+and thumbnail index in front of the same S3Storage.
+"""
+import os
+import sys
+import time
+import socket
+import logging
+import hashlib
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from seafile_thumbnail import settings
+from seafile_thumbnail.storage import S3Storage, TieredStorage
+from seafile_thumbnail.thumbnail_index import ThumbnailIndex
+
+SIZE = 256
+
+
+def start_moto_server():
+    from moto.server import ThreadedMotoServer
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    # no line per request
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+    server.start()
+    return server, 'http://127.0.0.1:%s' % port
+
+
+def new_node(root, remote):
+    # THUMBNAIL_DIR is global, the node last created is the one in use
+    settings.THUMBNAIL_DIR = root
+    index = ThumbnailIndex(os.path.join(root, '.index.db'), os.path.join(root, '.gc.lock'))
+    return TieredStorage(index, remote, 30, 100000, 30)
+
+
+def timed(name, count, func, *args):
+    t1 = time.perf_counter()
+    result = func(*args)
+    t2 = time.perf_counter()
+    print('%-15s %5d  total %7.3fs  %7.2f ms each' % (name, count, t2 - t1, (t2 - t1) * 1000 / count))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--endpoint-url')
+    parser.add_argument('--bucket', default='thumbnails')
+    parser.add_argument('--access-key', default='testing')
+    parser.add_argument('--secret-key', default='testing')
+    parser.add_argument('--count', type=int, default=100)
+    args = parser.parse_args()
+
+    server, endpoint_url = None, args.endpoint_url
+    if not endpoint_url:
+        server, endpoint_url = start_moto_server()
+    remote = S3Storage(args.bucket, prefix='thumbnail/', endpoint_url=endpoint_url, region_name='us-east-1',
+                       aws_access_key_id=args.access_key, aws_secret_access_key=args.secret_key)
+    if server:
+        remote.get_client().create_bucket(Bucket=args.bucket)
+
+    file_ids = [hashlib.sha1(b'file %d' % i).hexdigest() for i in range(args.count)]
+    missing_ids = [hashlib.sha1(b'missing %d' % i).hexdigest() for i in range(args.count)]
+    thumbnails = dict((file_id, os.urandom(4096)) for file_id in file_ids)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        writer = new_node(os.path.join(tmp_dir, 'writer'), remote)
+        timed('write', args.count, lambda: [writer.write(f, SIZE, thumbnails[f]) for f in file_ids])
+
+        reader = new_node(os.path.join(tmp_dir, 'reader'), remote)
+        entries = timed('copy from s3', args.count, lambda: [reader.find(f, SIZE) for f in file_ids])
+        assert all(entries), 'thumbnails written by one node are not found by another one'
+        assert all(reader.read(f, SIZE, local=True) == thumbnails[f] for f in file_ids)
+        timed('local hit', args.count, lambda: [reader.find(f, SIZE) for f in file_ids])
+
+        found = timed('miss', args.count, lambda: [reader.find(f, SIZE) for f in missing_ids])
+        assert not any(found)
+        timed('cached miss', args.count, lambda: [reader.find(f, SIZE) for f in missing_ids])
+
+        timed('delete', args.count, lambda: [reader.delete(f, SIZE) for f in file_ids])
+        assert not any(remote.read(f, SIZE) for f in file_ids), 'deleted thumbnails are still in s3'
+        assert not any(reader.find(f, SIZE, local=True) for f in file_ids)
+
+        stats = reader.stats()
+        print('remote hits %(remote_hits)s  misses %(remote_misses)s  errors %(remote_errors)s' % stats)
+        assert stats['remote_errors'] == 0 and not stats['remote_down']
+
+    if server:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
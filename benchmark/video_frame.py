@@ -0,0 +1,125 @@
+""" Time and bytes read to get a thumbnail frame of a video served over
+HTTP, downloading the whole video (before) or reading it with range
+requests (after).
+
+    python benchmark/video_frame.py --duration 120 --bitrate 8M
+    python benchmark/video_frame.py --video sample.mov
+
+Without --video a sample video (moov atom at the end, like most phone
+videos) is created with ffmpeg. The video is served by a local HTTP
+server that supports range requests and counts the bytes it sends.
+"""
+import os
+import re
+import sys
+import time
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.server
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from seafile_thumbnail import settings
+from seafile_thumbnail.fileserver import FileServerClient
+from seafile_thumbnail.video import extract_video_frame, get_ffmpeg_binary
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    video = None
+    bytes_sent = 0
+
+    def do_GET(self):
+        file_size = os.path.getsize(self.video)
+        start, end = 0, file_size - 1
+        match = re.match(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), end) if match.group(2) else end
+            else:
+                start = file_size - int(match.group(2))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end, file_size))
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+
+        remaining = end - start + 1
+        with open(self.video, 'rb') as f:
+            f.seek(start)
+            try:
+                while remaining > 0:
+                    chunk = f.read(min(remaining, 64 * 1024))
+                    self.wfile.write(chunk)
+                    RangeHandler.bytes_sent += len(chunk)
+                    remaining -= len(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+def create_video(path, duration, bitrate):
+    subprocess.run([
+        get_ffmpeg_binary(), '-v', 'error', '-y', '-f', 'lavfi',
+        '-i', 'testsrc2=size=1920x1080:rate=30', '-t', str(duration),
+        '-c:v', 'libx264', '-b:v', bitrate, '-g', '300', '-pix_fmt', 'yuv420p', path,
+    ], check=True)
+
+
+def download_whole_video(url, tmp_dir, frame_time):
+    from moviepy.editor import VideoFileClip
+    tmp_video = os.path.join(tmp_dir, 'downloaded')
+    urllib.request.urlretrieve(url, tmp_video)
+    clip = VideoFileClip(tmp_video)
+    clip.save_frame(os.path.join(tmp_dir, 'frame.png'), t=frame_time)
+    clip.close()
+    os.unlink(tmp_video)
+
+
+def range_requests(url, tmp_dir, frame_time):
+    client = FileServerClient(url, 4, 30, 0)
+    extract_video_frame(client, url, settings.THUMBNAIL_SIZE_FOR_ORIGINAL)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--video')
+    parser.add_argument('--duration', type=int, default=120)
+    parser.add_argument('--bitrate', default='8M')
+    parser.add_argument('--frame-time', type=float, default=settings.THUMBNAIL_VIDEO_FRAME_TIME)
+    args = parser.parse_args()
+    settings.THUMBNAIL_VIDEO_FRAME_TIME = args.frame_time
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        video = args.video
+        if not video:
+            video = os.path.join(tmp_dir, 'sample.mp4')
+            create_video(video, args.duration, args.bitrate)
+
+        RangeHandler.video = video
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:%s/files/token/sample.mp4' % server.server_address[1]
+        print('video: %.1f MB, frame at %ss' % (os.path.getsize(video) / 1024 ** 2, args.frame_time))
+
+        for func in (download_whole_video, range_requests):
+            RangeHandler.bytes_sent = 0
+            t1 = time.perf_counter()
+            func(url, tmp_dir, args.frame_time)
+            t2 = time.perf_counter()
+            print('%-20s time %7.3fs  read %8.2f MB' % (
+                func.__name__, t2 - t1, RangeHandler.bytes_sent / 1024 ** 2))
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,44 @@
 import re
 import os
+import hmac
+import logging
 
+from seafile_thumbnail import settings
 from seafile_thumbnail.http_request import HTTPRequest
 from seafile_thumbnail.http_response import gen_error_response, gen_text_response, gen_thumbnail_response, \
-    gen_cache_response, create_thumbnail_response
-from seafile_thumbnail.serializers import ThumbnailSerializer
-from seafile_thumbnail.thumbnail import Thumbnail
+    gen_cache_response, create_thumbnail_response, gen_json_response, gen_thumbnail_response_start, \
+    gen_response_body, gen_zerocopy_body, gen_pathsend_body, gen_task_response, gen_redirect_response, \
+    gen_proxy_response, gen_placeholder_response
+from seafile_thumbnail.serializers import ThumbnailSerializer, session_cache, share_link_cache
+from seafile_thumbnail.thumbnail import generate_thumbnail, get_placeholder
+from seafile_thumbnail.executor import metadata_stage, io_stage, peer_stage, render_stage
+from seafile_thumbnail.single_flight import thumbnail_flights
+from seafile_thumbnail.metadata import metadata_cache
+from seafile_thumbnail.cache import hot_thumbnail_cache, failed_thumbnail_cache, InvalidFileError
+from seafile_thumbnail.disk_cache import disk_cache_manager
+from seafile_thumbnail.task_queue import thumbnail_task_manager, PRIORITY_VIEW, PRIORITY_CREATE
+from seafile_thumbnail.storage import thumbnail_storage
+from seafile_thumbnail.peers import peer_router
 from seafile_thumbnail.utils import cache_check
 
+logger = logging.getLogger(__name__)
+
 
 class App:
+    def __init__(self):
+        thumbnail_task_manager.init(self, peer_router.get_task_id_prefix())
+        if settings.ENABLE_THUMBNAIL_STATS and not settings.THUMBNAIL_STATS_TOKEN:
+            logger.warning('ENABLE_THUMBNAIL_STATS needs THUMBNAIL_STATS_TOKEN, /stats refuses all requests.')
+
     async def __call__(self, scope, receive, send):
+        # started in the server process, not before it is forked
+        disk_cache_manager.run()
+
         # request
         request = HTTPRequest(**scope)
-        if request.method != 'GET':
+        if request.method == 'HEAD':
+            send = self.head_send(send)
+        elif request.method != 'GET':
             response_stat, response_body = gen_error_response(
                 405, 'Method %s not allowed' % request.method
             )
@@ -21,6 +46,30 @@ class App:
             await send(response_body)
             return
 
+        try:
+            await self.route(request, send)
+        except (AssertionError, ValueError) as e:
+            if len(e.args) == 2 and isinstance(e.args[0], int):
+                status, err_msg = e.args
+            else:
+                logger.exception(e)
+                status, err_msg = 500, 'Internal server error.'
+            response_stat, response_body = gen_error_response(status, err_msg)
+            await send(response_stat)
+            await send(response_body)
+
+    def head_send(self, send):
+        # answer HEAD like GET, without the body
+        async def wrapper(message):
+            if message['type'] in ('http.response.body', 'http.response.zerocopy',
+                                   'http.response.pathsend'):
+                if message.get('more_body'):
+                    return
+                message = gen_response_body(b'')
+            await send(message)
+        return wrapper
+
+    async def route(self, request, send):
 #========= router=======
 # ------ping
         if request.url in ('ping', 'ping/'):
@@ -28,77 +77,26 @@ class App:
             await send(response_stat)
             await send(response_body)
             return
-# ------thumbnail
-        elif re.match('^thumbnail/(?P<repo_id>[-0-9a-f]{36})/create/$', request.url):
-            serializer = ThumbnailSerializer(request)
-            thumbnail_info = serializer.thumbnail_info
-            thumbnail = Thumbnail(**thumbnail_info)
-            last_modified = thumbnail.last_modified
-            etag = thumbnail.etag
-            repo_id = thumbnail.repo_id
-            file_path = thumbnail.file_path
-            size = thumbnail.size
-            response_start, response_body = create_thumbnail_response(
-                repo_id, file_path, size, etag, last_modified)
-            await send(response_start)
+# ------stats
+        elif request.url in ('stats', 'stats/') and settings.ENABLE_THUMBNAIL_STATS:
+            if self.stats_allowed(request):
+                response_stat, response_body = gen_json_response(self.stats())
+            else:
+                response_stat, response_body = gen_error_response(403, 'Forbidden')
+            await send(response_stat)
             await send(response_body)
             return
+# ------thumbnail
+        elif re.match('^thumbnail/task/(?P<task_id>[0-9a-f]{32})/$', request.url):
+            await self.query_task(request, send)
+        elif re.match('^thumbnail/(?P<repo_id>[-0-9a-f]{36})/create/$', request.url):
+            await self.create_thumbnail(request, send)
         elif re.match('^thumbnail/(?P<repo_id>[-0-9a-f]{36})/(?P<size>[0-9]+)/(?P<path>.*)$', request.url):
-            serializer = ThumbnailSerializer(request)
-            thumbnail_info = serializer.thumbnail_info
-            if not os.path.exists(thumbnail_info['thumbnail_path']):
-                thumbnail = Thumbnail(**thumbnail_info)
-                last_modified = thumbnail.last_modified
-                etag = thumbnail.etag
-                response_start, response_body = gen_thumbnail_response(
-                    thumbnail.body, etag, last_modified)
-                await send(response_start)
-                await send(response_body)
-                return
-            with open(thumbnail_info['thumbnail_path'], 'rb') as f:
-                thumbnail = f.read()
-                last_modified = thumbnail_info['last_modified']
-                etag = thumbnail_info['etag']
-                response_start, response_body = gen_thumbnail_response(
-                    thumbnail, etag, last_modified)
-                await send(response_start)
-                await send(response_body)
-                return
+            await self.get_thumbnail(request, send)
         elif re.match('^thumbnail/(?P<token>[a-f0-9]+)/create/$', request.url):
-            serializer = ThumbnailSerializer(request)
-            thumbnail_info = serializer.thumbnail_info
-            thumbnail = Thumbnail(**thumbnail_info)
-            last_modified = thumbnail.last_modified
-            etag = thumbnail.etag
-            repo_id = thumbnail.repo_id
-            file_path = thumbnail.file_path
-            size = thumbnail.size
-            response_start, response_body = create_thumbnail_response(
-                repo_id, file_path, size, etag, last_modified)
-            await send(response_start)
-            await send(response_body)
-            return
+            await self.create_thumbnail(request, send)
         elif re.match('^thumbnail/(?P<token>[a-f0-9]+)/(?P<size>[0-9]+)/(?P<path>.*)$', request.url):
-            serializer = ThumbnailSerializer(request)
-            thumbnail_info = serializer.thumbnail_info
-            if not os.path.exists(thumbnail_info['thumbnail_path']):
-                thumbnail = Thumbnail(**thumbnail_info)
-                last_modified = thumbnail.last_modified
-                etag = thumbnail.etag
-                response_start, response_body = gen_thumbnail_response(
-                    thumbnail.body, etag, last_modified)
-                await send(response_start)
-                await send(response_body)
-                return
-            with open(thumbnail_info['thumbnail_path'], 'rb') as f:
-                thumbnail = f.read()
-                last_modified = thumbnail_info['last_modified']
-                etag = thumbnail_info['etag']
-                response_start, response_body = gen_thumbnail_response(
-                    thumbnail, etag, last_modified)
-                await send(response_start)
-                await send(response_body)
-                return
+            await self.get_thumbnail(request, send)
         else:
             response_stat, response_body = gen_error_response(
                 404, 'Not Found'
@@ -107,5 +105,197 @@ class App:
             await send(response_body)
             return
 
+    async def create_thumbnail(self, request, send):
+        serializer = await metadata_stage.run(ThumbnailSerializer, request)
+        thumbnail_info = serializer.thumbnail_info
+        if not await io_stage.run(thumbnail_storage.find, thumbnail_info['file_id'], int(thumbnail_info['size'])):
+            owner = peer_router.get_owner(thumbnail_info['file_id'], request)
+            if owner and await self.send_to_owner(request, send, owner):
+                return
+            task_type = thumbnail_task_manager.get_task_type(thumbnail_info)
+            if task_type:
+                await self.send_task(send, task_type, thumbnail_info, PRIORITY_CREATE)
+                return
+            await self.generate_thumbnail(thumbnail_info)
+
+        response_start, response_body = create_thumbnail_response(
+            thumbnail_info['repo_id'], thumbnail_info['file_path'], thumbnail_info['size'],
+            thumbnail_info['etag'], thumbnail_info['last_modified'])
+        await send(response_start)
+        await send(response_body)
+
+    async def get_thumbnail(self, request, send):
+        serializer = await metadata_stage.run(ThumbnailSerializer, request)
+        thumbnail_info = serializer.thumbnail_info
+        key = (thumbnail_info['file_id'], int(thumbnail_info['size']))
+        if cache_check(request, thumbnail_info):
+            # the client's copy is still valid, do not touch the disk. The
+            # hit still counts for the disk cache
+            thumbnail_storage.record_hit(*key)
+            response_start, response_body = gen_cache_response(
+                thumbnail_info['etag'], thumbnail_info['last_modified'])
+            await send(response_start)
+            await send(response_body)
+            return
+
+        thumbnail = hot_thumbnail_cache.get(key)
+        if thumbnail is not None:
+            thumbnail_storage.record_hit(*key)
+        else:
+            f, file_size = await io_stage.run(thumbnail_storage.open, *key)
+            if f is None:
+                owner = peer_router.get_owner(thumbnail_info['file_id'], request)
+                if owner and await self.send_to_owner(request, send, owner):
+                    return
+                task_type = thumbnail_task_manager.get_task_type(thumbnail_info)
+                if task_type:
+                    await self.send_task(send, task_type, thumbnail_info, PRIORITY_VIEW, placeholder=True)
+                    return
+                thumbnail = await self.generate_thumbnail(thumbnail_info)
+            else:
+                thumbnail_storage.record_hit(*key)
+                try:
+                    if not hot_thumbnail_cache.should_admit(key, file_size):
+                        await self.send_file(request, send, f, file_size, thumbnail_info)
+                        return
+                    thumbnail = await io_stage.run(f.read)
+                finally:
+                    f.close()
+            hot_thumbnail_cache.add(key, thumbnail)
+
+        response_start, response_body = gen_thumbnail_response(
+            thumbnail, thumbnail_info['etag'], thumbnail_info['last_modified'])
+        await send(response_start)
+        await send(response_body)
+
+    async def send_file(self, request, send, f, file_size, thumbnail_info):
+        response_start = gen_thumbnail_response_start(
+            file_size, thumbnail_info['etag'], thumbnail_info['last_modified'])
+        await send(response_start)
+
+        # let the server send the file without copying it through python
+        # when it supports it, the same opened file is handed over
+        if 'http.response.zerocopy' in request.extensions:
+            await send(gen_zerocopy_body(f, file_size))
+            return
+        if 'http.response.pathsend' in request.extensions:
+            await send(gen_pathsend_body(os.path.abspath(f.name)))
+            return
+
+        remaining = file_size
+        while True:
+            chunk = await io_stage.run(f.read, min(remaining, settings.THUMBNAIL_RESPONSE_CHUNK_SIZE))
+            remaining -= len(chunk)
+            more_body = bool(chunk) and remaining > 0
+            await send(gen_response_body(chunk, more_body=more_body))
+            if not more_body:
+                return
+
+    async def send_task(self, send, task_type, thumbnail_info, priority, placeholder=False):
+        # generated in the background, the client polls the task. An <img>
+        # gets a placeholder image and reloads after Retry-After
+        self.check_failure(thumbnail_info)
+        task_id = await thumbnail_task_manager.add_task(task_type, thumbnail_info, priority)
+        if placeholder:
+            response_start, response_body = gen_placeholder_response(
+                get_placeholder(int(thumbnail_info['size'])), task_id, settings.THUMBNAIL_TASK_RETRY_AFTER)
+            await send(response_start)
+            await send(response_body)
+            return
+        task_status = await io_stage.run(thumbnail_task_manager.query_status, task_id)
+        response_start, response_body = gen_task_response(
+            202, task_status, settings.THUMBNAIL_TASK_RETRY_AFTER)
+        await send(response_start)
+        await send(response_body)
+
+    async def query_task(self, request, send):
+        task_id = request.url.split('/')[2]
+        owner = peer_router.get_task_owner(task_id, request)
+        if owner and await self.send_to_owner(request, send, owner):
+            return
+        task_status = await io_stage.run(thumbnail_task_manager.query_status, task_id)
+        retry_after = None
+        if task_status['status'] in ('pending', 'running'):
+            retry_after = settings.THUMBNAIL_TASK_RETRY_AFTER
+        response_start, response_body = gen_task_response(200, task_status, retry_after)
+        await send(response_start)
+        await send(response_body)
+
+    async def send_to_owner(self, request, send, owner):
+        # the owner generates the thumbnail, once for all nodes, return
+        # False if it does not answer
+        if peer_router.mode == 'redirect':
+            response_start, response_body = gen_redirect_response(
+                peer_router.redirect(owner, request), owner)
+        else:
+            response = await peer_stage.run(peer_router.forward, owner, request)
+            if response is None:
+                return False
+            response_start, response_body = gen_proxy_response(*response)
+        await send(response_start)
+        await send(response_body)
+        return True
+
+    def check_failure(self, thumbnail_info):
+        # do not download and decode a file again that just failed
+        key = (thumbnail_info['file_id'], int(thumbnail_info['size']))
+        failure = failed_thumbnail_cache.get(key)
+        if failure:
+            raise AssertionError(*failure)
+
+    async def generate_thumbnail(self, thumbnail_info, stage=render_stage):
+        # concurrent misses of the same thumbnail share one generation
+        key = (thumbnail_info['file_id'], int(thumbnail_info['size']))
+        self.check_failure(thumbnail_info)
+
+        try:
+            thumbnail = await thumbnail_flights.run(key, stage.run, generate_thumbnail, thumbnail_info)
+        except Exception as e:
+            # the cached dirent may point to an old version of the file
+            metadata_cache.invalidate_repo(thumbnail_info['repo_id'])
+            self.add_failure(key, e)
+            raise
+        failed_thumbnail_cache.delete(key)
+        disk_cache_manager.record_write()
+        return thumbnail
+
+    def add_failure(self, key, e):
+        if isinstance(e, AssertionError) and len(e.args) == 2 and isinstance(e.args[0], int):
+            status, err_msg = e.args
+        else:
+            status, err_msg = 500, 'Internal server error.'
+        # only failures of the file itself, not of a busy or unavailable
+        # fileserver, storage or worker
+        if not isinstance(e, InvalidFileError) and not 400 <= status < 500:
+            return
+        failed_thumbnail_cache.add(key, status, err_msg)
+
+    def stats_allowed(self, request):
+        # the client address says nothing behind a proxy on the same host
+        if not settings.THUMBNAIL_STATS_TOKEN:
+            return False
+        token = request.headers.get('x-thumbnail-stats-token', [''])[0]
+        return hmac.compare_digest(token.encode('utf-8'), settings.THUMBNAIL_STATS_TOKEN.encode('utf-8'))
+
+    def stats(self):
+        return {
+            'stages': {
+                'metadata': metadata_stage.stats(),
+                'io': io_stage.stats(),
+                'peer': peer_stage.stats(),
+                'render': render_stage.stats(),
+            },
+            'generations_in_flight': thumbnail_flights.in_flight(),
+            'thumbnail_tasks': thumbnail_task_manager.stats(),
+            'hot_thumbnail_cache': hot_thumbnail_cache.stats(),
+            'failed_thumbnail_cache': failed_thumbnail_cache.stats(),
+            'disk_cache': disk_cache_manager.stats(),
+            'storage': thumbnail_storage.stats(),
+            'peers': peer_router.stats(),
+            'session_cache': session_cache.stats(),
+            'share_link_cache': share_link_cache.stats(),
+            'metadata_cache': metadata_cache.stats(),
+        }
+
 
-app = App()
\ No newline at end of file
+app = App()
@@ -0,0 +1,191 @@
+import time
+import threading
+from collections import OrderedDict
+
+from seafile_thumbnail import settings
+
+
+class TTLCache(object):
+    """ A thread safe LRU cache whose entries expire `ttl` seconds after
+    they were set.
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key)
+            if item is not None:
+                value, expire_at = item
+                if expire_at > time.monotonic():
+                    self.data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        expire_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.data[key] = (value, expire_at)
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.data),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+class HotThumbnailCache(object):
+    """ Byte budgeted LRU of thumbnail bodies, keyed by (file_id, size).
+
+    A thumbnail is only admitted once it was requested `admit_hits` times,
+    so one pass over a large folder does not push the hot thumbnails out.
+    Only used from the event loop thread.
+    """
+    def __init__(self, max_bytes, max_item_bytes, admit_hits, max_candidates=100000):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.admit_hits = admit_hits
+        self.max_candidates = max_candidates
+        self.data = OrderedDict()
+        self.used_bytes = 0
+        # key -> number of requests of keys not admitted yet
+        self.candidates = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        body = self.data.get(key)
+        if body is not None:
+            self.data.move_to_end(key)
+            self.hits += 1
+            return body
+
+        self.misses += 1
+        self.candidates[key] = self.candidates.get(key, 0) + 1
+        self.candidates.move_to_end(key)
+        while len(self.candidates) > self.max_candidates:
+            self.candidates.popitem(last=False)
+        return None
+
+    def should_admit(self, key, size=0):
+        if key in self.data or size > self.max_item_bytes:
+            return False
+        return self.candidates.get(key, 0) >= self.admit_hits
+
+    def add(self, key, body):
+        """ Admit `body` if its key was requested often enough. """
+        if not body or not self.should_admit(key, len(body)):
+            return
+
+        del self.candidates[key]
+        self.data[key] = body
+        self.used_bytes += len(body)
+        while self.used_bytes > self.max_bytes:
+            _, evicted = self.data.popitem(last=False)
+            self.used_bytes -= len(evicted)
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            'items': len(self.data),
+            'used_bytes': self.used_bytes,
+            'max_bytes': self.max_bytes,
+            'candidates': len(self.candidates),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class InvalidFileError(AssertionError):
+    """ AssertionError(status, err_msg) of a thumbnail that can not be made
+    from the file itself: it can not be decoded, is too large or lacks the
+    part the thumbnail is made of. Only these failures and 4xx ones are kept
+    in FailedThumbnailCache, an unavailable fileserver or storage is not a
+    property of the file.
+    """
+
+
+class FailedThumbnailCache(object):
+    """ LRU of failed thumbnail generations, keyed by (file_id, size).
+
+    A failed thumbnail is not generated again before its retry time, the
+    retry interval doubles with every failure. file_id is the content of
+    the file, an entry only goes away when it is evicted or the thumbnail
+    is generated. Only used from the event loop thread.
+    """
+    def __init__(self, max_size, retry_interval, max_retry_interval):
+        self.max_size = max_size
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        # key -> (status, err_msg, failures, retry_at)
+        self.data = OrderedDict()
+        self.hits = 0
+
+    def get(self, key):
+        """ (status, err_msg) of the failure of `key` if it is not to be
+        retried yet, otherwise None
+        """
+        item = self.data.get(key)
+        if item is None:
+            return None
+        status, err_msg, failures, retry_at = item
+        if retry_at <= time.monotonic():
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return status, err_msg
+
+    def add(self, key, status, err_msg):
+        item = self.data.get(key)
+        if item and item[3] > time.monotonic():
+            # the waiters of one shared generation fail together
+            return
+        failures = item[2] + 1 if item else 1
+        interval = min(self.retry_interval * 2 ** (failures - 1), self.max_retry_interval)
+        self.data[key] = (status, err_msg, failures, time.monotonic() + interval)
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def stats(self):
+        return {
+            'size': len(self.data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+        }
+
+
+hot_thumbnail_cache = HotThumbnailCache(settings.HOT_THUMBNAIL_CACHE_SIZE,
+                                        settings.HOT_THUMBNAIL_MAX_ITEM_SIZE,
+                                        settings.HOT_THUMBNAIL_ADMIT_HITS)
+failed_thumbnail_cache = FailedThumbnailCache(settings.FAILED_THUMBNAIL_CACHE_SIZE,
+                                              settings.FAILED_THUMBNAIL_RETRY_INTERVAL,
+                                              settings.FAILED_THUMBNAIL_MAX_RETRY_INTERVAL)
@@ -21,6 +21,7 @@ SEADOC = 'SDoc'
 # content type
 TEXT_CONTENT_TYPE = b'text/plain'
 THUMBNAIL_CONTENT_TYPE = b'image/png'
+JSON_CONTENT_TYPE = b'application/json; charset=utf-8'
 
 # extensions of previewed files
 TEXT_PREVIEW_EXT = """ac, am, bat, c, cc, cmake, cpp, cs, css, diff, el, h, html, htm, java, js, json, less, make, org, php, pl, properties, py, rb, scala, script, sh, sql, txt, text, tex, vi, vim, xhtml, xml, log, csv, groovy, rst, patch, go, yml"""
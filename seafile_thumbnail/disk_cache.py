@@ -0,0 +1,310 @@
+""" Keep the thumbnails under THUMBNAIL_DIR within a byte and a file budget.
+
+The usage and the last hit of every thumbnail are read from the thumbnail
+index. The hits of served thumbnails are recorded in memory and written to the
+index every THUMBNAIL_CACHE_HIT_FLUSH_INTERVAL seconds by the background thread
+of the server, a last hit is refreshed at most every
+THUMBNAIL_CACHE_TOUCH_INTERVAL. When the cache is over a budget the least
+recently used thumbnails are removed down to THUMBNAIL_CACHE_GC_TARGET of the
+budgets.
+
+The server processes run the GC in a background thread, it can also be
+run from cron:
+
+    python -m seafile_thumbnail.disk_cache [--dry-run] [--migrate] [--rebuild-index]
+
+It also moves the thumbnails of the old flat THUMBNAIL_DIR/<size>/<file_id>
+layout into the sharded one, once, and builds the index from the thumbnail
+files when it is new. The mtime of a thumbnail mirrors its last hit, so a
+rebuilt index keeps them.
+"""
+import os
+import time
+import fcntl
+import logging
+import argparse
+import threading
+
+from seafile_thumbnail import settings
+from seafile_thumbnail.utils import get_thumbnail_path
+from seafile_thumbnail.thumbnail_index import thumbnail_index, GC_LOCK_FILE
+
+logger = logging.getLogger(__name__)
+
+# written when no thumbnail of the flat layout is left
+MIGRATED_FILE = '.flat_layout_migrated'
+
+
+class DiskCacheGC(object):
+    """ Removes the least recently used thumbnails under `root` when they
+    take more than `max_bytes` or `max_files`, 0 is no limit.
+
+    The thumbnails to remove are read from `index` in batches, least
+    recently used first. Every `batch_size` entries removed or walked with
+    os.scandir it sleeps `pause` seconds so it does not starve the server
+    of disk I/O.
+    """
+    def __init__(self, root, index, max_bytes, max_files, target, batch_size, pause):
+        self.root = root
+        self.index = index
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.target = target
+        self.batch_size = batch_size
+        self.pause = pause
+        self.scanned = 0
+        self.last_run = None
+        # (files, bytes) at the last run
+        self.usage = None
+
+    def is_internal(self, name):
+        # the lock file and thumbnails being written
+        return name.startswith('.') or name.endswith('.tmp')
+
+    def throttle(self):
+        self.scanned += 1
+        if self.scanned % self.batch_size == 0:
+            time.sleep(self.pause)
+
+    def scan(self, path=None):
+        """ yield (path, size, mtime) of every thumbnail under `path` """
+        try:
+            it = os.scandir(path or self.root)
+        except FileNotFoundError:
+            return
+        with it:
+            for entry in it:
+                self.throttle()
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        yield from self.scan(entry.path)
+                    elif entry.is_file(follow_symlinks=False) and not self.is_internal(entry.name):
+                        stat = entry.stat(follow_symlinks=False)
+                        yield entry.path, stat.st_size, stat.st_mtime
+                except FileNotFoundError:
+                    # removed by the server meanwhile
+                    continue
+
+    def get_excess(self, used_bytes, used_files):
+        """ (bytes, files) to remove, (0, 0) if the cache is within budget """
+        over_budget = (self.max_bytes and used_bytes > self.max_bytes) or \
+            (self.max_files and used_files > self.max_files)
+        if not over_budget:
+            return 0, 0
+        excess_bytes = max(0, used_bytes - int(self.max_bytes * self.target)) if self.max_bytes else 0
+        excess_files = max(0, used_files - int(self.max_files * self.target)) if self.max_files else 0
+        return excess_bytes, excess_files
+
+    def collect(self, dry_run=False):
+        """ Remove thumbnails until the cache is within budget, return
+        (removed files, removed bytes).
+        """
+        self.scanned = 0
+        used_files, used_bytes = self.usage = self.index.totals()
+        excess_bytes, excess_files = self.get_excess(used_bytes, used_files)
+        logger.info('Thumbnail cache uses %s bytes in %s files.' % (used_bytes, used_files))
+        if not (excess_bytes or excess_files):
+            return 0, 0
+
+        removed_bytes = removed_files = 0
+        for file_id, size, path, length in self.index.iter_oldest(self.batch_size):
+            if removed_bytes >= excess_bytes and removed_files >= excess_files:
+                break
+            self.throttle()
+            if not dry_run:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                self.index.remove(file_id, size)
+            removed_bytes += length
+            removed_files += 1
+        if not dry_run:
+            self.usage = (used_files - removed_files, used_bytes - removed_bytes)
+
+        logger.info('Removed %s bytes in %s files from thumbnail cache.' % (removed_bytes, removed_files))
+        return removed_files, removed_bytes
+
+    def migrate_flat_layout(self):
+        """ Move the thumbnails of the flat layout into the sharded one,
+        return the number of moved thumbnails.
+        """
+        migrated_file = os.path.join(self.root, MIGRATED_FILE)
+        if not settings.THUMBNAIL_MIGRATE_FLAT_LAYOUT or os.path.exists(migrated_file):
+            return 0
+
+        moved = 0
+        self.scanned = 0
+        with os.scandir(self.root) as size_dirs:
+            for size_dir in size_dirs:
+                if not (size_dir.name.isdigit() and size_dir.is_dir(follow_symlinks=False)):
+                    continue
+                with os.scandir(size_dir.path) as it:
+                    for entry in it:
+                        self.throttle()
+                        if self.is_internal(entry.name) or not entry.is_file(follow_symlinks=False):
+                            continue
+                        thumbnail_path = get_thumbnail_path(entry.name, size_dir.name)
+                        os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+                        try:
+                            os.rename(entry.path, thumbnail_path)
+                        except FileNotFoundError:
+                            # moved by a request meanwhile
+                            continue
+                        moved += 1
+
+        with open(migrated_file, 'w'):
+            pass
+        logger.info('Moved %s thumbnails into the sharded layout.' % moved)
+        return moved
+
+    def rebuild_index(self):
+        """ Index every thumbnail file under root, return their number.
+
+        The old entries are removed in batches first. A thumbnail looked up
+        meanwhile is indexed from its file, those entries are kept.
+        """
+        logger.info('Rebuild thumbnail index from %s.' % self.root)
+        while self.index.clear_batch(self.batch_size):
+            time.sleep(self.pause)
+        self.scanned = 0
+        entries = []
+        indexed = 0
+        for path, length, mtime in self.scan():
+            # <size>/ab/cd/<file_id>
+            parts = os.path.relpath(path, self.root).split(os.sep)
+            if len(parts) != 4 or not parts[0].isdigit():
+                continue
+            entries.append((parts[3], int(parts[0]), path, length, settings.THUMBNAIL_EXTENSION, mtime))
+            if len(entries) >= self.batch_size:
+                self.index.add_many(entries)
+                indexed += len(entries)
+                entries = []
+        self.index.add_many(entries)
+        indexed += len(entries)
+        self.index.set_built()
+        logger.info('Indexed %s thumbnails.' % indexed)
+        return indexed
+
+    def run_once(self, dry_run=False, collect=True, rebuild_index=False):
+        """ migrate_flat_layout(), rebuild_index() if the index is not built
+        yet and collect(), unless another process is doing it right now
+        """
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, GC_LOCK_FILE), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.info('Thumbnail cache gc is running in another process.')
+                return None
+            # a corrupt index found meanwhile is replaced under this lock
+            self.index.lock_held = True
+            try:
+                if not dry_run:
+                    self.migrate_flat_layout()
+                    if rebuild_index or not self.index.is_built():
+                        self.rebuild_index()
+                if not collect:
+                    return 0, 0
+                self.last_run = time.time()
+                return self.collect(dry_run)
+            finally:
+                self.index.lock_held = False
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class DiskCacheManager(object):
+    """ Runs the GC in a background thread of the server, every `interval`
+    seconds and early when `check_writes` thumbnails were written since the
+    last run. The thread also writes the recorded thumbnail hits to the
+    index every `flush_interval` seconds, also when the GC is run from cron.
+    """
+    def __init__(self, gc, interval, check_writes, flush_interval):
+        self.gc = gc
+        self.interval = interval
+        self.check_writes = check_writes
+        self.flush_interval = flush_interval
+        self.writes = 0
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def record_write(self):
+        self.writes += 1
+        if self.check_writes and self.writes >= self.check_writes:
+            self.wakeup.set()
+
+    def flush_hits(self):
+        try:
+            self.gc.index.flush_hits()
+        except Exception as e:
+            logger.exception('Failed to write thumbnail hits: %s' % e)
+
+    def loop(self):
+        # thumbnails of the flat layout are moved and a new index is built
+        # right away, not after the first interval
+        if settings.ENABLE_THUMBNAIL_CACHE_GC:
+            try:
+                self.gc.run_once(collect=False)
+            except Exception as e:
+                logger.exception('Thumbnail cache migration failed: %s' % e)
+        next_run = time.monotonic() + self.interval
+        while True:
+            self.wakeup.wait(max(0, min(self.flush_interval, next_run - time.monotonic())))
+            woken = self.wakeup.is_set()
+            self.wakeup.clear()
+            # the latest hits count in the gc
+            self.flush_hits()
+            if not settings.ENABLE_THUMBNAIL_CACHE_GC or not (woken or time.monotonic() >= next_run):
+                continue
+            self.writes = 0
+            next_run = time.monotonic() + self.interval
+            try:
+                self.gc.run_once()
+            except Exception as e:
+                logger.exception('Thumbnail cache gc failed: %s' % e)
+
+    def run(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.loop, name='ThumbnailCacheGC', daemon=True)
+        self.thread.start()
+
+    def stats(self):
+        # not counted here, it takes a while with millions of thumbnails
+        used_files, used_bytes = self.gc.usage or (None, None)
+        return {
+            'used_bytes': used_bytes,
+            'used_files': used_files,
+            'max_bytes': self.gc.max_bytes,
+            'max_files': self.gc.max_files,
+            'writes_since_gc': self.writes,
+            'last_run': self.gc.last_run,
+        }
+
+
+disk_cache_gc = DiskCacheGC(settings.THUMBNAIL_DIR, thumbnail_index, settings.THUMBNAIL_CACHE_MAX_BYTES,
+                            settings.THUMBNAIL_CACHE_MAX_FILES, settings.THUMBNAIL_CACHE_GC_TARGET,
+                            settings.THUMBNAIL_CACHE_GC_BATCH_SIZE, settings.THUMBNAIL_CACHE_GC_PAUSE)
+disk_cache_manager = DiskCacheManager(disk_cache_gc, settings.THUMBNAIL_CACHE_GC_INTERVAL,
+                                      settings.THUMBNAIL_CACHE_GC_CHECK_WRITES,
+                                      settings.THUMBNAIL_CACHE_HIT_FLUSH_INTERVAL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Remove the least recently used thumbnails.')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be removed')
+    parser.add_argument('--migrate', action='store_true',
+                        help='only move the thumbnails of the flat layout into the sharded one '
+                             'and build the index, remove no thumbnail')
+    parser.add_argument('--rebuild-index', action='store_true',
+                        help='rebuild the thumbnail index from the thumbnail files first')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    result = disk_cache_gc.run_once(dry_run=args.dry_run, collect=not args.migrate,
+                                    rebuild_index=args.rebuild_index)
+    if result is not None and not args.migrate:
+        print('removed %s files, %s bytes' % result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, BrokenExecutor
+
+from seafile_thumbnail import settings
+
+logger = logging.getLogger(__name__)
+
+
+def process_pool(max_workers):
+    # seaserv keeps rpc connections open, so never fork them into workers
+    return ProcessPoolExecutor(max_workers=max_workers,
+                               mp_context=multiprocessing.get_context('spawn'))
+
+
+class Stage(object):
+    """ An executor with a limit on the number of pending jobs.
+
+    Jobs submitted while the stage is full are rejected with 503, so a slow
+    stage can not build an unbounded backlog in front of the other ones.
+    """
+    def __init__(self, name, executor_factory, workers, queue_limit):
+        self.name = name
+        self.executor_factory = executor_factory
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.pending = 0
+        self.executor = None
+
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = self.executor_factory(max_workers=self.workers)
+        return self.executor
+
+    async def run(self, func, *args, **kwargs):
+        # only touched from the event loop thread, no lock needed
+        if self.pending >= self.queue_limit:
+            logger.warning('%s stage is full, %s jobs pending.' % (self.name, self.pending))
+            raise AssertionError(503, 'Server busy.')
+
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.get_executor(),
+                                              functools.partial(func, *args, **kwargs))
+        except BrokenExecutor as e:
+            # a worker process died (e.g. crashed in a decoder), start a new pool
+            logger.error('%s stage executor is broken: %s' % (self.name, e))
+            self.executor = None
+            raise AssertionError(500, 'Internal server error.')
+        finally:
+            self.pending -= 1
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'pending': self.pending,
+            'queue_limit': self.queue_limit,
+        }
+
+
+metadata_stage = Stage('metadata', ThreadPoolExecutor, settings.THUMBNAIL_METADATA_WORKERS,
+                       settings.THUMBNAIL_METADATA_QUEUE_LIMIT)
+io_stage = Stage('io', ThreadPoolExecutor, settings.THUMBNAIL_IO_WORKERS,
+                 settings.THUMBNAIL_IO_QUEUE_LIMIT)
+peer_stage = Stage('peer', ThreadPoolExecutor, settings.THUMBNAIL_PEER_WORKERS,
+                   settings.THUMBNAIL_PEER_QUEUE_LIMIT)
+render_stage = Stage('render', process_pool, settings.THUMBNAIL_RENDER_WORKERS,
+                     settings.THUMBNAIL_RENDER_QUEUE_LIMIT)
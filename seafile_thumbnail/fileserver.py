@@ -0,0 +1,239 @@
+import io
+import time
+import queue
+import logging
+import threading
+import http.client
+import urllib.parse
+
+from seafile_thumbnail import settings
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+# the fileserver is restarting or overloaded, worth another try
+RETRY_STATUS = (502, 503, 504)
+RETRY_ERRORS = (http.client.HTTPException, OSError)
+
+
+class ConnectError(Exception):
+    """ The server could not be connected to, the cause of the AssertionError
+    of a request that failed so.
+    """
+
+
+class FileServerResponse(object):
+    """ A response whose body is read from the socket on demand.
+
+    The connection goes back to the pool when the response is closed after
+    the body was read completely, otherwise it is closed.
+    """
+    def __init__(self, client, conn, response):
+        self.client = client
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def getheaders(self):
+        return self.response.getheaders()
+
+    def read(self, amt=None):
+        return self.response.read(amt)
+
+    def iter_chunks(self, chunk_size=CHUNK_SIZE):
+        while True:
+            chunk = self.response.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        if self.conn is None:
+            return
+        self.client.release(self.conn, reusable=self.response.isclosed())
+        self.conn = None
+
+
+class RangeFile(io.RawIOBase):
+    """ A read-only, seekable file over range requests, so that parsers
+    which seek read only the parts of a file they need.
+
+    Use it through FileServerClient.open_range_file, which adds buffering.
+    """
+    def __init__(self, client, url, size):
+        self.client = client
+        self.url = url
+        self.size = size
+        self.pos = 0
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('negative seek position %s' % offset)
+        self.pos = offset
+        return self.pos
+
+    def readinto(self, b):
+        end = min(self.pos + len(b), self.size)
+        if end <= self.pos:
+            return 0
+        data = self.client.read_range(self.url, self.pos, end)
+        if data is None:
+            raise AssertionError(500, 'Fileserver does not support range requests.')
+        b[:len(data)] = data
+        self.pos += len(data)
+        self.bytes_read += len(data)
+        return len(data)
+
+
+class FileServerClient(object):
+    """ Keep-alive connections to one fileserver, shared by all threads.
+
+    At most `max_connections` requests are in progress at the same time,
+    failed connects, dropped connections and 502/503/504 answers are retried
+    `retries` times. `timeout` is the connect timeout, and the read timeout
+    unless `read_timeout` is given.
+    """
+    def __init__(self, root, max_connections, timeout, retries, read_timeout=None):
+        url = urllib.parse.urlsplit(root)
+        self.root = root
+        self.scheme = url.scheme
+        self.host = url.hostname
+        self.port = url.port
+        self.timeout = timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.idle_conns = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(max_connections)
+
+    def new_conn(self):
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def get_conn(self):
+        """ return (conn, whether it is an idle one) """
+        try:
+            return self.idle_conns.get_nowait(), True
+        except queue.Empty:
+            return self.new_conn(), False
+
+    def close_idle(self):
+        while True:
+            try:
+                self.idle_conns.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def release(self, conn, reusable=True):
+        if reusable:
+            self.idle_conns.put(conn)
+        else:
+            conn.close()
+        self.slots.release()
+
+    def request(self, path, headers):
+        """ return (conn, response) of GET `path`, transient errors are retried """
+        last_error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(0.1 * 2 ** attempt)
+            conn, idle = self.get_conn()
+            if conn.sock is None:
+                try:
+                    conn.connect()
+                except OSError as e:
+                    conn.close()
+                    last_error = ConnectError('%s: %s' % (self.root, e))
+                    logger.warning('Failed to connect to %s: %s' % (self.root, e))
+                    continue
+                if self.read_timeout is not None:
+                    conn.sock.settimeout(self.read_timeout)
+            try:
+                conn.request('GET', path, headers=headers or {})
+                response = conn.getresponse()
+            except RETRY_ERRORS as e:
+                # also a keep-alive connection closed by the server, the
+                # other idle ones are likely closed too
+                conn.close()
+                if idle:
+                    self.close_idle()
+                last_error = e
+                logger.warning('Failed to request %s: %s' % (self.root, e))
+                continue
+
+            if response.status in RETRY_STATUS and attempt < self.retries:
+                response.read()
+                self.idle_conns.put(conn)
+                continue
+            return conn, response
+
+        raise AssertionError(500, 'Internal server error.') from last_error
+
+    def open(self, url, headers=None, raise_for_status=True):
+        """ GET `url` and return a FileServerResponse, close it when done.
+
+        An error status is raised as AssertionError unless not
+        `raise_for_status`.
+        """
+        parts = urllib.parse.urlsplit(url)
+        path = urllib.parse.urlunsplit(('', '', parts.path, parts.query, ''))
+        if not self.slots.acquire(timeout=self.timeout):
+            logger.warning('No free connection to fileserver %s.' % self.root)
+            raise AssertionError(503, 'Server busy.')
+        try:
+            conn, response = self.request(path, headers)
+        except Exception:
+            self.slots.release()
+            raise
+
+        file_server_response = FileServerResponse(self, conn, response)
+        if raise_for_status and response.status >= 400:
+            file_server_response.read()
+            file_server_response.close()
+            logger.warning('Fileserver returns %s.' % response.status)
+            if response.status == 404:
+                raise AssertionError(404, 'File not found.')
+            raise AssertionError(500, 'Internal server error.')
+        return file_server_response
+
+    def read(self, url):
+        with self.open(url) as response:
+            return response.read()
+
+    def read_range(self, url, start, end):
+        """ bytes [start, end) of `url`, None if the fileserver ignores Range """
+        with self.open(url, {'Range': 'bytes=%d-%d' % (start, end - 1)}) as response:
+            if response.status != 206:
+                return None
+            return response.read()
+
+    def open_range_file(self, url, size, buffer_size=CHUNK_SIZE):
+        """ a seekable file object of `url`, read with range requests """
+        return io.BufferedReader(RangeFile(self, url, size), buffer_size)
+
+
+fileserver = FileServerClient(settings.INNER_FILE_SERVER_ROOT, settings.FILE_SERVER_MAX_CONNECTIONS,
+                              settings.FILE_SERVER_TIMEOUT, settings.FILE_SERVER_RETRIES)
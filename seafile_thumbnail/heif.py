@@ -0,0 +1,65 @@
+import logging
+from io import BytesIO
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+try:
+    # pillow_heif decodes an embedded thumbnail item instead of the primary
+    # image when it is large enough, through Image.draft()
+    import pillow_heif
+    pillow_heif.register_heif_opener()
+except ImportError:
+    pillow_heif = None
+
+
+def get_exif_orientation(metadata):
+    """ EXIF orientation in the metadata of a pyheif image, 1 if none """
+    for item in metadata or []:
+        if item['type'] != 'Exif':
+            continue
+        data = item['data']
+        if not data.startswith(b'Exif'):
+            # the raw Exif item starts with the offset of the TIFF header
+            data = data[4 + int.from_bytes(data[:4], 'big'):]
+        exif = Image.Exif()
+        try:
+            exif.load(data)
+        except Exception as e:
+            logger.info('Invalid HEIF exif: %s' % e)
+            return 1
+        return exif.get(0x0112, 1)
+    return 1
+
+
+def open_heif(data, check_image_size):
+    """ Return (image, orientation) of the HEIF image in `data`, the
+    orientation is None if it was already applied.
+
+    `check_image_size` is called with the undecoded image.
+    """
+    if pillow_heif is not None:
+        image = Image.open(BytesIO(data), formats=['HEIF'])
+        check_image_size(image)
+        # libheif rotates the image by its irot/imir boxes and resets the
+        # EXIF orientation
+        return image, None
+
+    import pyheif
+    container = pyheif.open_container(data, apply_transformations=False)
+    heif_image = container.primary_image.image
+    check_image_size(heif_image)
+    heif_image.load()
+    # a view of the decoded buffer, not a copy
+    image = Image.frombuffer(heif_image.mode, heif_image.size, heif_image.data,
+                             'raw', heif_image.mode, heif_image.stride, 1)
+
+    # the transformations are left to get_rotated_image, irot/imir boxes
+    # are expressed as an EXIF orientation, 0 if there are none
+    transformations = heif_image.transformations
+    left, top, width, height = transformations.crop
+    if (left, top, width, height) != (0, 0) + image.size:
+        image = image.crop((left, top, left + width, top + height))
+    orientation = transformations.orientation_tag or get_exif_orientation(heif_image.metadata)
+    return image, orientation
@@ -7,6 +7,7 @@ import seafile_thumbnail.settings as settings
 class HTTPRequest(object):
     def __init__(self, **scope):
         self.__dict__.update(scope)
+        self.extensions = scope.get('extensions') or {}
         self.parse()
 
     def parse(self):
@@ -1,7 +1,8 @@
 from urllib.parse import quote
 import json
 
-from seafile_thumbnail.constants import TEXT_CONTENT_TYPE, THUMBNAIL_CONTENT_TYPE, EMPTY_BYTES
+from seafile_thumbnail.constants import TEXT_CONTENT_TYPE, THUMBNAIL_CONTENT_TYPE, JSON_CONTENT_TYPE, \
+    EMPTY_BYTES
 from seafile_thumbnail.utils import get_thumbnail_src
 
 
@@ -15,10 +16,29 @@ def gen_response_start(status, content_type):
     }
 
 
-def gen_response_body(body):
+def gen_response_body(body, more_body=False):
     return {
         'type': 'http.response.body',
-        'body': body
+        'body': body,
+        'more_body': more_body
+    }
+
+
+def gen_zerocopy_body(file, count):
+    # asgi http.response.zerocopy extension, the server sends from `file`
+    return {
+        'type': 'http.response.zerocopy',
+        'file': file,
+        'count': count,
+        'more_body': False
+    }
+
+
+def gen_pathsend_body(path):
+    # asgi http.response.pathsend extension, the server opens `path` itself
+    return {
+        'type': 'http.response.pathsend',
+        'path': path
     }
 
 
@@ -36,16 +56,72 @@ def gen_text_response(text):
     return response_start, response_body
 
 
-def gen_thumbnail_response(thumbnail, etag, last_modified):
+def gen_json_response(data):
+    response_start = gen_response_start(200, JSON_CONTENT_TYPE)
+    response_body = gen_response_body(json.dumps(data).encode('utf-8'))
+
+    return response_start, response_body
+
+
+def gen_task_response(status, task_status, retry_after=None):
+    response_start = gen_response_start(status, JSON_CONTENT_TYPE)
+    if retry_after:
+        response_start['headers'].append([b'Retry-After', str(retry_after).encode('utf-8')])
+    response_body = gen_response_body(json.dumps(task_status).encode('utf-8'))
+
+    return response_start, response_body
+
+
+def gen_placeholder_response(placeholder, task_id, retry_after):
+    # an image for <img> tags, not cached, the task id for clients that poll
+    response_start = gen_response_start(202, THUMBNAIL_CONTENT_TYPE)
+    response_start['headers'].append([b'Content-Length', str(len(placeholder)).encode('utf-8')])
+    response_start['headers'].append([b'Cache-Control', b'no-store'])
+    response_start['headers'].append([b'Retry-After', str(retry_after).encode('utf-8')])
+    response_start['headers'].append([b'X-Thumbnail-Task', task_id.encode('utf-8')])
+    response_body = gen_response_body(placeholder)
+
+    return response_start, response_body
+
+
+def gen_redirect_response(location, owner):
+    # the owner in a header too, for a proxy in front to route by
+    response_start = gen_response_start(307, TEXT_CONTENT_TYPE)
+    response_start['headers'].append([b'Location', location.encode('utf-8')])
+    response_start['headers'].append([b'X-Thumbnail-Owner', owner.encode('utf-8')])
+    response_body = gen_response_body(EMPTY_BYTES)
+
+    return response_start, response_body
+
+
+def gen_proxy_response(status, headers, body):
+    response_start = {
+        'type': 'http.response.start',
+        'status': status,
+        'headers': headers,
+    }
+    response_body = gen_response_body(body)
+
+    return response_start, response_body
+
+
+def gen_thumbnail_response_start(content_length, etag, last_modified):
     response_start = gen_response_start(200, THUMBNAIL_CONTENT_TYPE)
-    response_body = gen_response_body(thumbnail)
+    response_start['headers'].append([b'Content-Length', str(content_length).encode('utf-8')])
 
     # cache
-    if thumbnail:
+    if content_length:
         response_start['headers'].append([b'Cache-Control', b'max-age=604800, public'])
         response_start['headers'].append([b'ETag', etag.encode('utf-8')])
         response_start['headers'].append([b'Last-Modified', last_modified.encode('utf-8')])
 
+    return response_start
+
+
+def gen_thumbnail_response(thumbnail, etag, last_modified):
+    response_start = gen_thumbnail_response_start(len(thumbnail), etag, last_modified)
+    response_body = gen_response_body(thumbnail)
+
     return response_start, response_body
 
 
@@ -66,8 +142,11 @@ def create_thumbnail_response(repo_id, file_path, size, etag, last_modified):
     return response_start, response_body
 
 
-def gen_cache_response():
+def gen_cache_response(etag, last_modified):
     response_start = gen_response_start(304, THUMBNAIL_CONTENT_TYPE)
+    response_start['headers'].append([b'Cache-Control', b'max-age=604800, public'])
+    response_start['headers'].append([b'ETag', etag.encode('utf-8')])
+    response_start['headers'].append([b'Last-Modified', last_modified.encode('utf-8')])
     response_body = gen_response_body(EMPTY_BYTES)
 
     return response_start, response_body
\ No newline at end of file
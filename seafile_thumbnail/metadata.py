@@ -0,0 +1,69 @@
+import threading
+from collections import namedtuple
+
+from seafile_thumbnail import settings
+from seafile_thumbnail.cache import TTLCache
+
+from seaserv import get_repo, get_file_size, seafile_api
+
+RepoInfo = namedtuple('RepoInfo', ['id', 'encrypted', 'store_id', 'version'])
+DirentInfo = namedtuple('DirentInfo', ['obj_id', 'mtime'])
+
+
+class MetadataCache(object):
+    """ Short lived cache of seaserv repo and dirent lookups.
+
+    Dirents are cached under the current generation of their repo, so
+    `invalidate_repo` drops every cached path of a repo at once.
+    """
+    def __init__(self, max_size, repo_ttl, dirent_ttl):
+        self.repos = TTLCache(max_size, repo_ttl)
+        self.dirents = TTLCache(max_size, dirent_ttl)
+        # file_id is content addressed, its size never changes
+        self.file_sizes = TTLCache(max_size, 24 * 3600)
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def get_repo(self, repo_id):
+        repo = self.repos.get(repo_id)
+        if repo is None:
+            repo = get_repo(repo_id)
+            if not repo:
+                return None
+            repo = RepoInfo(repo.id, repo.encrypted, repo.store_id, repo.version)
+            self.repos.set(repo_id, repo)
+        return repo
+
+    def get_dirent(self, repo_id, path):
+        key = (repo_id, self.generations.get(repo_id, 0), path)
+        dirent = self.dirents.get(key)
+        if dirent is None:
+            file_obj = seafile_api.get_dirent_by_path(repo_id, path)
+            if not file_obj:
+                return None
+            dirent = DirentInfo(file_obj.obj_id, file_obj.mtime)
+            self.dirents.set(key, dirent)
+        return dirent
+
+    def get_file_size(self, repo, file_id):
+        file_size = self.file_sizes.get(file_id)
+        if file_size is None:
+            file_size = get_file_size(repo.store_id, repo.version, file_id)
+            self.file_sizes.set(file_id, file_size)
+        return file_size
+
+    def invalidate_repo(self, repo_id):
+        self.repos.delete(repo_id)
+        with self.lock:
+            self.generations[repo_id] = self.generations.get(repo_id, 0) + 1
+
+    def stats(self):
+        return {
+            'repos': self.repos.stats(),
+            'dirents': self.dirents.stats(),
+            'file_sizes': self.file_sizes.stats(),
+        }
+
+
+metadata_cache = MetadataCache(settings.METADATA_CACHE_SIZE, settings.REPO_CACHE_TTL,
+                               settings.DIRENT_CACHE_TTL)
@@ -0,0 +1,91 @@
+import re
+import mmap
+import logging
+
+from fitz import TOOLS, Matrix, open as fitz_open
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# the linearization dictionary is in the first 1024 bytes of a linearized pdf
+PDF_HEAD_SIZE = 1024
+LINEARIZED_RE = re.compile(rb'/Linearized\s[^>]*>>', re.S)
+LINEARIZED_KEY_RE = re.compile(rb'/(L|E|T)\s+(\d+)')
+# /T points at the first entry of the main xref table, its header is before
+XREF_HEADER_SIZE = 1024
+
+
+def get_first_page_ranges(head, file_size):
+    """ (end of first page, start of main xref) of a linearized pdf, or None
+
+    A linearized pdf starts with everything needed to show the first page
+    and ends with the cross-reference table of the other objects. The hints
+    are only valid if the file was not updated after linearizing, i.e. its
+    length is still /L.
+    """
+    match = LINEARIZED_RE.search(head)
+    if not match:
+        return None
+    keys = dict((k, int(v)) for k, v in LINEARIZED_KEY_RE.findall(match.group()))
+    if keys.get(b'L') != file_size or b'E' not in keys or b'T' not in keys:
+        return None
+    first_page_end, main_xref = keys[b'E'], keys[b'T']
+    if not 0 < first_page_end <= main_xref < file_size:
+        return None
+    return first_page_end, max(first_page_end, main_xref - XREF_HEADER_SIZE)
+
+
+def read_pdf(client, url, file_size):
+    """ Return (data, complete) of the pdf at `url`, data is the complete pdf
+    or only the bytes needed for its first page.
+
+    For a linearized pdf only the first page section and the trailing
+    cross-reference table are read, into an anonymous mapping of the file
+    size, so all offsets stay valid. The pages in between are never written
+    and take no memory. Other pdfs, or a fileserver ignoring Range or
+    returning less than asked for, are read completely.
+    """
+    head = client.read_range(url, 0, min(PDF_HEAD_SIZE, file_size))
+    ranges = get_first_page_ranges(head, file_size) if head is not None else None
+    if not ranges:
+        return client.read(url), True
+
+    first_page_end, main_xref = ranges
+    # private, reading a page never written maps the shared zero page
+    buf = mmap.mmap(-1, file_size, flags=mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS)
+    buf[:len(head)] = head
+    for start, end in ((len(head), first_page_end), (main_xref, file_size)):
+        if end <= start:
+            continue
+        data = client.read_range(url, start, end)
+        if data is None or len(data) != end - start:
+            logger.info('Fileserver returns %s bytes of range %s-%s of pdf, read it completely.' % (
+                None if data is None else len(data), start, end))
+            buf.close()
+            return client.read(url), True
+        buf[start:end] = data
+    logger.debug('Read %s of %s bytes of linearized pdf.' % (
+        first_page_end + file_size - main_xref, file_size))
+    return memoryview(buf), False
+
+
+def render_first_page(data, max_size, complete=True):
+    """ render the first page of the pdf in `data` fitted in `max_size` x
+    `max_size`, return a PIL image
+
+    mupdf draws what it can of objects it fails to read and only warns. For
+    a partly read pdf (not `complete`) a warning while drawing means the
+    page needs bytes that were not read, and ValueError is raised.
+    """
+    with fitz_open(stream=data, filetype='pdf') as doc:
+        page = doc[0]
+        rect = page.rect
+        zoom = max_size / max(rect.width, rect.height, 1)
+        # loading a partly read pdf warns about the objects not read, only
+        # the warnings of drawing the page matter
+        TOOLS.reset_mupdf_warnings()
+        pix = page.get_pixmap(matrix=Matrix(zoom, zoom), alpha=False)
+        warnings = TOOLS.mupdf_warnings()
+        if warnings and not complete:
+            raise ValueError('First page needs more than was read: %s' % warnings.replace('\n', '; '))
+        return Image.frombytes('RGB', (pix.width, pix.height), pix.samples)
@@ -0,0 +1,180 @@
+""" Thumbnail nodes behind a load balancer share the work by file id.
+
+Every file id is owned by one node of THUMBNAIL_PEERS on a consistent hash
+ring. A node that misses a thumbnail of a file it does not own lets the
+owner answer, by proxying the request or by redirecting it, so concurrent
+misses of a thumbnail are generated once in the cluster and every thumbnail
+stays hot on one node. Adding or removing a node moves only its share of
+file ids.
+
+Forwarded requests carry X-Thumbnail-Forwarded and are always answered by
+the node that gets them. An owner that can not be connected to is skipped
+for THUMBNAIL_PEER_RETRY_INTERVAL seconds, its file ids fall to the next node
+on the ring meanwhile. An owner that answers too slowly is not skipped, the
+request is answered locally.
+"""
+import time
+import bisect
+import hashlib
+import logging
+import urllib.parse
+
+from seafile_thumbnail import settings
+from seafile_thumbnail.fileserver import FileServerClient, ConnectError
+
+logger = logging.getLogger(__name__)
+
+FORWARDED_HEADER = 'x-thumbnail-forwarded'
+# request headers passed on to the owner, and response headers passed back
+FORWARD_HEADERS = ('cookie', 'if-none-match', 'if-modified-since', 'user-agent')
+RELAY_HEADERS = ('content-type', 'content-length', 'cache-control', 'etag',
+                 'last-modified', 'retry-after', 'x-thumbnail-task')
+# reserved characters and escapes of a url path and query
+URL_SAFE_CHARS = "/?:@!$&'()*+,;=%~"
+
+
+def hash_key(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing(object):
+    """ Consistent hash of keys to nodes, every node has `vnodes` points on
+    the ring so that the keys spread evenly.
+    """
+    def __init__(self, nodes, vnodes):
+        points = sorted((hash_key('%s#%s' % (node, i)), node) for node in nodes for i in range(vnodes))
+        self.hashes = [point[0] for point in points]
+        self.nodes = [point[1] for point in points]
+
+    def iter_nodes(self, key):
+        """ yield every node once, the owner of `key` first and then the
+        ones it falls to in turn
+        """
+        if not self.nodes:
+            return
+        start = bisect.bisect(self.hashes, hash_key(key))
+        seen = set()
+        for i in range(len(self.nodes)):
+            node = self.nodes[(start + i) % len(self.nodes)]
+            if node not in seen:
+                seen.add(node)
+                yield node
+
+
+class PeerRouter(object):
+    """ Finds the owner of a file id among `peers` (base urls, `self_url`
+    is this node) and hands it requests, in `mode` 'proxy' or 'redirect'.
+    """
+    def __init__(self, peers, self_url, mode, vnodes, connect_timeout, read_timeout, max_connections,
+                 retry_interval):
+        self.peers = [peer.rstrip('/') for peer in peers]
+        self.self_url = self_url.rstrip('/')
+        self.mode = mode
+        self.retry_interval = retry_interval
+        self.ring = HashRing(self.peers, vnodes)
+        # keep-alive connections to every other node, retried once for a
+        # connection the peer closed while idle. If the peer still fails the
+        # request is answered locally
+        self.clients = {peer: FileServerClient(peer, max_connections, connect_timeout, 1, read_timeout)
+                        for peer in self.peers if peer != self.self_url}
+        # peer -> time.monotonic() it is skipped until
+        self.down_until = {}
+        self.proxied = 0
+        self.redirected = 0
+        self.failed = 0
+
+        if self.peers and self.self_url not in self.peers:
+            raise ValueError('THUMBNAIL_PEER_SELF %s is not in THUMBNAIL_PEERS' % self_url)
+        if mode not in ('proxy', 'redirect'):
+            raise ValueError('Unknown THUMBNAIL_PEER_MODE %s' % mode)
+
+    def is_enabled(self):
+        return len(self.peers) > 1
+
+    def is_forwarded(self, request):
+        return FORWARDED_HEADER in request.headers
+
+    def get_task_id_prefix(self):
+        # task ids start with the index of the node that runs them, so a
+        # task status query can be sent there
+        if not self.is_enabled():
+            return ''
+        return '%02x' % self.peers.index(self.self_url)
+
+    def get_owner(self, file_id, request):
+        """ the url of the node that generates the thumbnails of `file_id`,
+        None if it is this node or `request` was forwarded
+        """
+        if not self.is_enabled() or self.is_forwarded(request):
+            return None
+        now = time.monotonic()
+        for peer in self.ring.iter_nodes(file_id):
+            if peer == self.self_url:
+                return None
+            if self.down_until.get(peer, 0) <= now:
+                return peer
+        return None
+
+    def get_task_owner(self, task_id, request):
+        """ the url of the node that runs the task, None if it is this node """
+        if not self.is_enabled() or self.is_forwarded(request):
+            return None
+        try:
+            peer = self.peers[int(task_id[:2], 16)]
+        except IndexError:
+            return None
+        return None if peer == self.self_url else peer
+
+    def get_url(self, peer, request):
+        # the path as the client sent it, request.path is decoded. Bytes
+        # not allowed in a url are escaped, the rest is passed as is
+        raw_path = getattr(request, 'raw_path', None) or request.path.encode('utf-8')
+        url = peer + urllib.parse.quote_from_bytes(raw_path, safe=URL_SAFE_CHARS)
+        if request.query_string:
+            url += '?' + urllib.parse.quote_from_bytes(request.query_string, safe=URL_SAFE_CHARS)
+        return url
+
+    def redirect(self, peer, request):
+        self.redirected += 1
+        return self.get_url(peer, request)
+
+    def forward(self, peer, request):
+        """ GET `request` from `peer` and return (status, headers, body),
+        None if the peer fails
+        """
+        headers = {name: request.headers[name][0] for name in FORWARD_HEADERS if name in request.headers}
+        headers[FORWARDED_HEADER] = self.self_url
+        try:
+            with self.clients[peer].open(self.get_url(peer, request), headers,
+                                         raise_for_status=False) as response:
+                body = response.read()
+                response_headers = [[name.encode('utf-8'), value.encode('utf-8')]
+                                    for name, value in response.getheaders()
+                                    if name.lower() in RELAY_HEADERS]
+        except Exception as e:
+            self.failed += 1
+            # a slow answer or a failed generation is not a reason to move
+            # the file ids of the owner
+            if isinstance(e.__cause__, ConnectError):
+                self.down_until[peer] = time.monotonic() + self.retry_interval
+            logger.warning('Failed to forward thumbnail request to %s: %s' % (peer, e))
+            return None
+        self.proxied += 1
+        return response.status, response_headers, body
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            'peers': len(self.peers),
+            'mode': self.mode,
+            'down': [peer for peer, until in self.down_until.items() if until > now],
+            'proxied': self.proxied,
+            'redirected': self.redirected,
+            'failed': self.failed,
+        }
+
+
+peer_router = PeerRouter(settings.THUMBNAIL_PEERS, settings.THUMBNAIL_PEER_SELF, settings.THUMBNAIL_PEER_MODE,
+                         settings.THUMBNAIL_PEER_VNODES, settings.THUMBNAIL_PEER_CONNECT_TIMEOUT,
+                         settings.THUMBNAIL_PEER_READ_TIMEOUT, settings.THUMBNAIL_PEER_MAX_CONNECTIONS,
+                         settings.THUMBNAIL_PEER_RETRY_INTERVAL)
@@ -0,0 +1,85 @@
+import sys
+import logging
+from array import array
+from io import BytesIO
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# image resource with a JPEG preview, written by Photoshop 5.0 and later
+THUMBNAIL_RESOURCE_ID = 1036
+THUMBNAIL_RESOURCE_HEADER_SIZE = 28
+THUMBNAIL_FORMAT_JPEG = 1
+# the composite is decoded in strips of about this many bytes per channel
+STRIP_SIZE = 4 * 1024 ** 2
+# modes whose composite channels are one byte per pixel each
+CHANNEL_MODES = ('L', 'RGB', 'RGBA', 'CMYK', 'LAB')
+
+
+def get_embedded_thumbnail(image):
+    """ the JPEG preview in the image resources of a PSD image, or None """
+    for resource_id, name, data in image.resources:
+        if resource_id != THUMBNAIL_RESOURCE_ID or len(data) <= THUMBNAIL_RESOURCE_HEADER_SIZE:
+            continue
+        if int.from_bytes(data[:4], 'big') != THUMBNAIL_FORMAT_JPEG:
+            continue
+        try:
+            thumbnail = Image.open(BytesIO(data[THUMBNAIL_RESOURCE_HEADER_SIZE:]))
+            thumbnail.load()
+        except Exception as e:
+            logger.info('Invalid PSD thumbnail resource: %s' % e)
+            return None
+        return thumbnail
+    return None
+
+
+def get_row_sizes(f, image):
+    """ compressed size of every row of every channel of the composite """
+    width, height = image.size
+    codec = image.tile[0][0]
+    if codec == 'raw':
+        return [width] * (len(image.tile) * height)
+
+    # the packbits row sizes table is right before the first channel
+    table_size = len(image.tile) * height * 2
+    f.seek(image.tile[0][2] - table_size)
+    row_sizes = array('H', f.read(table_size))
+    if sys.byteorder == 'little':
+        row_sizes.byteswap()
+    return row_sizes
+
+
+def decode_composite(f, image, max_size):
+    """ Decode the composite of the PSD image opened from `f` reduced to
+    not less than `max_size`.
+
+    Every channel is decoded in strips of rows, each strip is reduced right
+    away, so neither the full size image nor a full channel is ever in
+    memory. Layers are not read.
+    """
+    if image.mode not in CHANNEL_MODES or image.tile[0][0] not in ('raw', 'packbits'):
+        image.load()
+        return image
+
+    width, height = image.size
+    factor = max(1, max(width, height) // max_size)
+    reduced_size = (-(-width // factor), -(-height // factor))
+    strip_rows = max(1, STRIP_SIZE // width // factor) * factor
+    row_sizes = get_row_sizes(f, image)
+
+    channels = []
+    for index, (codec, extents, offset, rawmode) in enumerate(image.tile):
+        # CMYK channels are stored inverted
+        rawmode = 'L;I' if rawmode.endswith(';I') else 'L'
+        channel = Image.new('L', reduced_size)
+        for top in range(0, height, strip_rows):
+            rows = min(strip_rows, height - top)
+            first_row = index * height + top
+            size = sum(row_sizes[first_row:first_row + rows])
+            f.seek(offset)
+            strip = Image.frombytes('L', (width, rows), f.read(size), codec, rawmode)
+            channel.paste(strip.reduce(factor), (0, top // factor))
+            offset += size
+        channels.append(channel)
+    return Image.merge(image.mode, channels)
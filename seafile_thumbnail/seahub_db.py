@@ -1,11 +1,13 @@
 import os
+import queue
+import time
+import threading
 import configparser
 import logging
 
+from seafile_thumbnail import settings
 
-
-
-
+logger = logging.getLogger(__name__)
 
 
 def get_config(config_file):
@@ -40,64 +42,146 @@ def get_seahub_db_name():
     return db_name, None
 
 
-class SeahubDB(object):
-    def __init__(self):
-        self.seahub_db_conn = None
-        self.seahub_db_cursor = None
-        self.init_seahub_db()
-        self.db_name = get_seahub_db_name()[0]
-        if self.seahub_db_cursor is None:
-            raise RuntimeError('Failed to init seahub db.')
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.close_seahub_db()
+def get_seahub_db_info():
+    seahub_conf_dir = os.environ.get('SEAFILE_CENTRAL_CONF_DIR') or os.environ.get('CCNET_CONF_DIR')
+    if not seahub_conf_dir:
+        logging.warning('Environment variable seahub_conf_dir is not define')
+        return None
 
-    def init_seahub_db(self):
+    seahub_conf_path = os.path.join(seahub_conf_dir, 'seafevents.conf')
+    seahub_config = get_config(seahub_conf_path)
+
+    if not seahub_config.has_section('DATABASE'):
+        logger.warning('Failed to init seahub db, can not find db info in seahub.conf.')
+        return None
+
+    if seahub_config.get('DATABASE', 'type') != 'mysql':
+        logger.warning('Failed to init seahub db, only mysql db supported.')
+        return None
+
+    return {
+        'name': seahub_config.get('DATABASE', 'name', fallback='seahub'),
+        'host': seahub_config.get('DATABASE', 'host', fallback='127.0.0.1'),
+        'port': seahub_config.getint('DATABASE', 'port', fallback=3306),
+        'user': seahub_config.get('DATABASE', 'username'),
+        'passwd': seahub_config.get('DATABASE', 'password'),
+    }
+
+
+class SeahubDBPool(object):
+    """ Process wide pool of seahub db connections.
+
+    At most `max_size` connections are open at the same time. A connection
+    idle for more than `check_interval` seconds is pinged before it is
+    handed out again, dead ones are dropped and replaced.
+    """
+    def __init__(self, max_size, timeout, check_interval):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.idle_conns = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.db_info = None
+        self.lock = threading.Lock()
+
+    def get_db_info(self):
+        # seafevents.conf is only parsed once per process
+        with self.lock:
+            if self.db_info is None:
+                self.db_info = get_seahub_db_info()
+            return self.db_info
+
+    def connect(self):
         try:
             import pymysql
             pymysql.install_as_MySQLdb()
         except ImportError as e:
             logger.warning('Failed to init seahub db: %s.' % e)
-            return
-
-        seahub_conf_dir = os.environ.get('SEAFILE_CENTRAL_CONF_DIR') or os.environ.get('CCNET_CONF_DIR')
-        if not seahub_conf_dir:
-            logging.warning('Environment variable seahub_conf_dir is not define')
-            return
-
-        seahub_conf_path = os.path.join(seahub_conf_dir, 'seafevents.conf')
-        seahub_config = get_config(seahub_conf_path)
-
-        if not seahub_config.has_section('DATABASE'):
-            logger.warning('Failed to init seahub db, can not find db info in seahub.conf.')
-            return
-
-        if seahub_config.get('DATABASE', 'type') != 'mysql':
-            logger.warning('Failed to init seahub db, only mysql db supported.')
-            return
-        db_name = seahub_config.get('DATABASE', 'name', fallback='seahub')
-        db_host = seahub_config.get('DATABASE', 'host', fallback='127.0.0.1')
-        db_port = seahub_config.getint('DATABASE', 'port', fallback=3306)
-        db_user = seahub_config.get('DATABASE', 'username')
-        db_passwd = seahub_config.get('DATABASE', 'password')
+            return None
+
+        db_info = self.get_db_info()
+        if db_info is None:
+            return None
         try:
-            self.seahub_db_conn = pymysql.connect(host=db_host, port=db_port, user=db_user,
-                                                 passwd=db_passwd, db=db_name, charset='utf8')
-            self.seahub_db_conn.autocommit(True)
-            self.seahub_db_cursor = self.seahub_db_conn.cursor()
+            return pymysql.connect(host=db_info['host'], port=db_info['port'], user=db_info['user'],
+                                   passwd=db_info['passwd'], db=db_info['name'], charset='utf8',
+                                   autocommit=True)
         except Exception as e:
-            self.cursor = None
             logger.warning('Failed to init seahub db: %s.' % e)
-            return
+            return None
+
+    def close_conn(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def checkout(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            logger.warning('No free seahub db connection in %s seconds.' % self.timeout)
+            return None
+
+        while True:
+            try:
+                conn, last_used = self.idle_conns.get_nowait()
+            except queue.Empty:
+                break
+            if time.time() - last_used < self.check_interval:
+                return conn
+            try:
+                conn.ping(reconnect=False)
+                return conn
+            except Exception:
+                self.close_conn(conn)
+
+        conn = self.connect()
+        if conn is None:
+            self.slots.release()
+        return conn
+
+    def checkin(self, conn, discard=False):
+        if discard:
+            self.close_conn(conn)
+        else:
+            self.idle_conns.put((conn, time.time()))
+        self.slots.release()
+
+
+seahub_db_pool = SeahubDBPool(settings.SEAHUB_DB_POOL_SIZE, settings.SEAHUB_DB_POOL_TIMEOUT,
+                              settings.SEAHUB_DB_CONN_CHECK_INTERVAL)
+
+
+class SeahubDB(object):
+    """ A connection checked out from `seahub_db_pool`, give it back with
+    `close_seahub_db` or by using it as a context manager.
+    """
+    def __init__(self):
+        self.seahub_db_conn = seahub_db_pool.checkout()
+        self.broken = False
+        if self.seahub_db_conn is None:
+            raise RuntimeError('Failed to init seahub db.')
+        self.db_name = seahub_db_pool.get_db_info()['name']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close_seahub_db()
 
     def close_seahub_db(self):
-        if self.seahub_db_cursor:
-            self.seahub_db_cursor.close()
         if self.seahub_db_conn:
-            self.seahub_db_conn.close()
+            seahub_db_pool.checkin(self.seahub_db_conn, discard=self.broken)
+            self.seahub_db_conn = None
+
+    def execute(self, sql, args):
+        try:
+            with self.seahub_db_conn.cursor() as cursor:
+                cursor.execute(sql, args)
+                return cursor.fetchone()
+        except Exception:
+            # do not put a connection in unknown state back to the pool
+            self.broken = True
+            raise
 
     def get_valid_file_link_by_token(self, token):
         sql = f"""
@@ -105,16 +189,16 @@ class SeahubDB(object):
             FROM
                 `{self.db_name}`.`share_fileshare`
             WHERE
-                token = '{token}'
+                token = %s
         """
-        with self.seahub_db_cursor as cursor:
-            cursor.execute(sql)
-            data = cursor.fetchone()
-            repo_id = data[0]
-            path = data[1]
-            s_type = data[2]
+        data = self.execute(sql, (token,))
+        if not data:
+            return None
+        repo_id = data[0]
+        path = data[1]
+        s_type = data[2]
 
-            return repo_id, path, s_type
+        return repo_id, path, s_type
 
 
     def session_info(self, data):
@@ -127,11 +211,11 @@ class SeahubDB(object):
 
     def get_django_session_by_session_key(self, session_key):
         sql = f"""
-        SELECT *
+        SELECT session_key, session_data, expire_date
         FROM `{self.db_name}`.`django_session`
-        WHERE session_key = '{session_key}'
+        WHERE session_key = %s
         """
-        with self.seahub_db_cursor as cursor:
-            cursor.execute(sql)
-            data = cursor.fetchone()
-            return self.session_info(data)
+        data = self.execute(sql, (session_key,))
+        if not data:
+            return None
+        return self.session_info(data)
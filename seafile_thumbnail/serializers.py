@@ -5,23 +5,28 @@ from django.contrib.sessions.backends.db import SessionStore
 from email.utils import formatdate
 
 from seafile_thumbnail import settings
+from seafile_thumbnail.cache import TTLCache
+from seafile_thumbnail.metadata import metadata_cache
 from seafile_thumbnail.constants import IMAGE, VIDEO, XMIND, PDF
 from seafile_thumbnail.seahub_db import SeahubDB
 from seafile_thumbnail.utils import session_require, get_file_type_and_ext
-from seafile_thumbnail.utils import get_real_path_by_fs_and_req_path
-from seaserv import get_repo, get_file_id_by_path, seafile_api
+from seafile_thumbnail.utils import get_real_path_by_fs_and_req_path, get_thumbnail_path
+from seaserv import get_file_id_by_path
 
 dj_settings.configure(SECRET_KEY=settings.SEAHUB_WEB_SECRET_KEY)
 session_store = SessionStore()
 
+# session_key -> decoded session data
+session_cache = TTLCache(settings.SESSION_CACHE_SIZE, settings.SESSION_CACHE_TTL)
+# share link token -> (repo_id, path, s_type)
+share_link_cache = TTLCache(settings.SHARE_LINK_CACHE_SIZE, settings.SHARE_LINK_CACHE_TTL)
+
 
 class ThumbnailSerializer(object):
     def __init__(self, request):
-        self.db_cursor = SeahubDB()
         self.request = request
         self.check()
         self.gen_thumbnail_info()
-        self.db_cursor.close_seahub_db()
 
     def check(self):
         self.params_check()
@@ -44,12 +49,12 @@ class ThumbnailSerializer(object):
         file_path = self.params['file_path']
         repo_id = self.params['repo_id']
         size = self.params['size']
-        file_obj = seafile_api.get_dirent_by_path(repo_id, file_path)
+        file_obj = metadata_cache.get_dirent(repo_id, file_path)
+        if not file_obj:
+            raise AssertionError(404, 'File not found.')
         file_id = file_obj.obj_id
-        thumbnail_dir = os.path.join(settings.THUMBNAIL_DIR, str(size))
-        thumbnail_file = os.path.join(thumbnail_dir, file_id)
-        if not os.path.exists(thumbnail_dir):
-            os.makedirs(thumbnail_dir)
+        thumbnail_file = get_thumbnail_path(file_id, size)
+        thumbnail_dir = os.path.dirname(thumbnail_file)
         last_modified_time = file_obj.mtime
         last_modified = formatdate(int(last_modified_time), usegmt=True)
         etag = '"' + file_id + '"'
@@ -114,7 +119,7 @@ class ThumbnailSerializer(object):
                 err_msg = "Invalid arguments."
                 raise AssertionError(400, err_msg)
 
-            repo_id, path, stype = self.db_cursor.get_valid_file_link_by_token(token)
+            repo_id, path, stype = self.get_share_link(token)
             path = get_real_path_by_fs_and_req_path(stype, path, req_path)
             file_name = os.path.basename(path)
             filetype, fileext = get_file_type_and_ext(file_name)
@@ -128,12 +133,12 @@ class ThumbnailSerializer(object):
                 err_msg = "Invalid arguments."
                 raise AssertionError(400, err_msg)
 
-            repo_id, path, stype = self.db_cursor.get_valid_file_link_by_token(token)
+            repo_id, path, stype = self.get_share_link(token)
             path = get_real_path_by_fs_and_req_path(stype, path, req_path)
             file_name = os.path.basename(path)
             filetype, fileext = get_file_type_and_ext(file_name)
 
-        repo = get_repo(repo_id)
+        repo = metadata_cache.get_repo(repo_id)
         if not repo:
             err_msg = "Library does not exist."
             raise AssertionError(400, err_msg)
@@ -154,6 +159,31 @@ class ThumbnailSerializer(object):
             'file_path': path,
         }
 
+    def get_share_link(self, token):
+        share_link = share_link_cache.get(token)
+        if share_link:
+            return share_link
+
+        # only share link requests need a seahub db connection
+        with SeahubDB() as seahub_db:
+            share_link = seahub_db.get_valid_file_link_by_token(token)
+        if not share_link:
+            raise AssertionError(404, 'Link does not exist.')
+        share_link_cache.set(token, share_link)
+        return share_link
+
+    def get_session_data(self, session_key):
+        session_data = session_cache.get(session_key)
+        if session_data is None:
+            with SeahubDB() as seahub_db:
+                django_session = seahub_db.get_django_session_by_session_key(session_key)
+            if not django_session:
+                raise AssertionError(400, 'django session invalid.')
+            session_data = self.parse_django_session(django_session['session_data'])
+            session_cache.set(session_key, session_data)
+        # session_check adds keys to it, keep the cached one untouched
+        return dict(session_data)
+
     def parse_django_session(self, session_data):
         # django/contrib/sessions/backends/base.py
         return session_store.decode(session_data)
@@ -161,8 +191,7 @@ class ThumbnailSerializer(object):
     @session_require
     def session_check(self):
         session_key = self.request.cookies[settings.SESSION_KEY]
-        django_session = self.db_cursor.get_django_session_by_session_key(session_key)
-        self.session_data = self.parse_django_session(django_session['session_data'])
+        self.session_data = self.get_session_data(session_key)
         self.session_data['session_key'] = session_key
         username = self.session_data.get('_auth_user_name')
         if username:
@@ -14,11 +14,44 @@ INNER_FILE_SERVER_ROOT = 'http://127.0.0.1:8082'
 
 # dir
 THUMBNAIL_DIR = '/data/seahub-data/thumbnail'
+# thumbnails are stored as THUMBNAIL_DIR/<size>/ab/cd/<file_id>, ones of the
+# old THUMBNAIL_DIR/<size>/<file_id> layout are moved there when they are
+# read and by a background migration. Turn it off once that has finished.
+THUMBNAIL_MIGRATE_FLAT_LAYOUT = True
+# index of the thumbnails, a SQLite database in WAL mode. It is rebuilt from
+# THUMBNAIL_DIR when it is missing, keep it on a local disk.
+THUMBNAIL_INDEX_PATH = os.path.join(THUMBNAIL_DIR, '.thumbnail_index.db')
+# storage shared by all thumbnail nodes, THUMBNAIL_DIR is a local copy of it:
+# 'local' (not shared), 'nfs' (THUMBNAIL_NFS_DIR) or 's3' (THUMBNAIL_S3, the
+# arguments of S3Storage, needs boto3)
+THUMBNAIL_STORAGE = 'local'
+THUMBNAIL_NFS_DIR = ''
+THUMBNAIL_S3 = {
+    'bucket': '',
+    'prefix': 'thumbnail/',
+    'timeout': 5,  # seconds
+    # 'endpoint_url': 'http://127.0.0.1:9000',
+    # 'aws_access_key_id': '',
+    # 'aws_secret_access_key': '',
+}
+# a thumbnail missing in the shared storage is not looked up there again for
+# MISS_TTL seconds, and after an error the shared storage is skipped for
+# RETRY_INTERVAL seconds, thumbnails are generated locally meanwhile
+THUMBNAIL_STORAGE_MISS_TTL = 30  # seconds
+THUMBNAIL_STORAGE_MISS_CACHE_SIZE = 100000
+THUMBNAIL_STORAGE_RETRY_INTERVAL = 30  # seconds
 LOG_DIR = '/data/seahub-data/logs'
 
 # VIDEO thumbnail
 ENABLE_VIDEO_THUMBNAIL = True
 THUMBNAIL_VIDEO_FRAME_TIME = 5  # use the frame at 5 second as thumbnail
+# if that frame is black or blank, try frames spread over the video
+THUMBNAIL_VIDEO_SAMPLE_FRAMES = 4
+THUMBNAIL_VIDEO_GOOD_FRAME_SCORE = 20  # luminance standard deviation, scaled down for dark frames
+# limits of extracting one video frame, the video is read with range requests
+THUMBNAIL_VIDEO_TIME_BUDGET = 30  # seconds
+THUMBNAIL_VIDEO_BYTE_BUDGET = 64 * 1024 ** 2  # bytes
+THUMBNAIL_VIDEO_RANGE_WINDOW = 1024 ** 2  # bytes asked from the fileserver per request
 # xmind thumbnail
 ENABLE_XMIND_THUMBNAIL = True
 # pdf thumbnails
@@ -32,6 +65,10 @@ THUMBNAIL_IMAGE_ORIGINAL_SIZE_LIMIT = 256
 THUMBNAIL_DEFAULT_SIZE = 256
 THUMBNAIL_SIZE_FOR_GRID = 512
 THUMBNAIL_SIZE_FOR_ORIGINAL = 1024
+# generate all these sizes from one decode of the original file; a missing
+# size is derived from a larger cached one without fetching the original
+THUMBNAIL_SIZES = (THUMBNAIL_DEFAULT_SIZE, THUMBNAIL_SIZE_FOR_GRID, THUMBNAIL_SIZE_FOR_ORIGINAL)
+THUMBNAIL_GENERATE_ALL_SIZES = True
 
 # Absolute filesystem path to the directory that will hold thumbnail files.
 SEAHUB_DATA_ROOT = os.path.join(PROJECT_ROOT, '../../seahub-data')
@@ -49,3 +86,111 @@ SESSION_KEY = 'sessionid'
 SEAHUB_WEB_SECRET_KEY = 'n*v0=jz-1rz@(4gx^tf%6^e7c&um@2)g-l=3_)t@19a69n1nv6'
 
 
+
+# execution
+# blocking seaserv rpc / seahub db calls run in a thread pool, cached thumbnails
+# are read in another one, and thumbnails are rendered in a process pool, so the
+# event loop is never blocked. A stage rejects requests with 503 when it already
+# has QUEUE_LIMIT requests pending.
+THUMBNAIL_METADATA_WORKERS = 10
+THUMBNAIL_METADATA_QUEUE_LIMIT = 200
+THUMBNAIL_IO_WORKERS = 10
+THUMBNAIL_IO_QUEUE_LIMIT = 200
+THUMBNAIL_RENDER_WORKERS = 3
+THUMBNAIL_RENDER_QUEUE_LIMIT = 30
+
+# thumbnails of slow file types are generated in the background, the request
+# is answered with 202 and a task id, thumbnail/task/<task_id>/ tells when the
+# thumbnail is ready
+ENABLE_ASYNC_THUMBNAIL = True
+THUMBNAIL_TASK_QUEUES = {
+    # task type: (worker processes, queue size)
+    'video': (2, 100),
+    'pdf': (2, 100),
+    'psd': (1, 50),
+}
+THUMBNAIL_TASK_EXPIRE_TIME = 30 * 60  # seconds the result of a task is kept
+THUMBNAIL_TASK_RETRY_AFTER = 2  # seconds, sent to clients as Retry-After
+
+# seahub db connection pool
+SEAHUB_DB_POOL_SIZE = 10
+SEAHUB_DB_POOL_TIMEOUT = 10  # seconds to wait for a free connection
+SEAHUB_DB_CONN_CHECK_INTERVAL = 60  # ping connections idle for longer than this
+
+# in-process caches of seahub db lookups, keep the ttl(seconds) short so that
+# logouts and removed share links take effect quickly
+SESSION_CACHE_TTL = 10
+SESSION_CACHE_SIZE = 10000
+SHARE_LINK_CACHE_TTL = 10
+SHARE_LINK_CACHE_SIZE = 10000
+
+# in-process caches of seaserv repo and dirent lookups, a changed file is
+# seen after at most DIRENT_CACHE_TTL seconds
+REPO_CACHE_TTL = 60
+DIRENT_CACHE_TTL = 5
+METADATA_CACHE_SIZE = 100000
+
+# /stats shows queue depths, cache sizes, the storage and the peer urls. Off
+# by default, when enabled it only answers requests sending
+# THUMBNAIL_STATS_TOKEN in an X-Thumbnail-Stats-Token header
+ENABLE_THUMBNAIL_STATS = False
+THUMBNAIL_STATS_TOKEN = ''
+
+# in-memory cache of frequently requested thumbnails, per worker process
+HOT_THUMBNAIL_CACHE_SIZE = 64 * 1024 ** 2  # bytes
+HOT_THUMBNAIL_MAX_ITEM_SIZE = 1024 ** 2  # bytes
+HOT_THUMBNAIL_ADMIT_HITS = 2  # requests before a thumbnail is kept in memory
+
+# generations that failed because of the file (undecodable, too large, not
+# found) are not retried before the retry interval(seconds), it doubles with
+# every failure of the same thumbnail up to the max interval. Failures of the
+# fileserver, storage or workers are not remembered
+FAILED_THUMBNAIL_CACHE_SIZE = 100000
+FAILED_THUMBNAIL_RETRY_INTERVAL = 60
+FAILED_THUMBNAIL_MAX_RETRY_INTERVAL = 24 * 3600
+
+# disk cache of thumbnails under THUMBNAIL_DIR, when it takes more than
+# MAX_BYTES or MAX_FILES (0 is no limit) the least recently used thumbnails
+# are removed down to GC_TARGET of the budgets. The server checks it every
+# GC_INTERVAL seconds, or after GC_CHECK_WRITES new thumbnails, or run
+# `python -m seafile_thumbnail.disk_cache` from cron.
+ENABLE_THUMBNAIL_CACHE_GC = True
+THUMBNAIL_CACHE_MAX_BYTES = 50 * 1024 ** 3
+THUMBNAIL_CACHE_MAX_FILES = 5000000
+THUMBNAIL_CACHE_GC_TARGET = 0.9
+THUMBNAIL_CACHE_GC_INTERVAL = 3600  # seconds
+THUMBNAIL_CACHE_GC_CHECK_WRITES = 10000
+THUMBNAIL_CACHE_GC_BATCH_SIZE = 1000  # entries scanned between pauses
+THUMBNAIL_CACHE_GC_PAUSE = 0.01  # seconds
+# hits of served thumbnails, from disk, memory or 304 answers, are written to
+# the index every HIT_FLUSH_INTERVAL seconds, in one transaction. The last
+# hit(and mtime) of a thumbnail is refreshed if older than TOUCH_INTERVAL
+THUMBNAIL_CACHE_HIT_FLUSH_INTERVAL = 60  # seconds
+THUMBNAIL_CACHE_TOUCH_INTERVAL = 3600  # seconds
+
+# chunk size(bytes) of streamed thumbnail responses, used when the asgi server
+# supports neither the zerocopy nor the pathsend extension
+THUMBNAIL_RESPONSE_CHUNK_SIZE = 64 * 1024
+
+# thumbnail nodes behind a load balancer: base urls of all nodes, the same
+# list on every node, and the one of this node. Every node generates the
+# thumbnails of its consistent hash share of file ids, a miss of another
+# node's thumbnail is proxied to it, or redirected with 307 and an
+# X-Thumbnail-Owner header for a proxy in front. [] is a single node.
+THUMBNAIL_PEERS = []
+THUMBNAIL_PEER_SELF = ''
+THUMBNAIL_PEER_MODE = 'proxy'  # or 'redirect'
+THUMBNAIL_PEER_VNODES = 160  # points per node on the hash ring
+THUMBNAIL_PEER_CONNECT_TIMEOUT = 3  # seconds, a node that is not connected to is skipped
+THUMBNAIL_PEER_READ_TIMEOUT = 120  # seconds, the owner may be generating the thumbnail
+THUMBNAIL_PEER_MAX_CONNECTIONS = 10  # per peer and process
+THUMBNAIL_PEER_RETRY_INTERVAL = 30  # a failed peer is skipped this long(seconds)
+# proxied requests wait for the owner in their own thread pool, not in the io
+# stage that serves cached thumbnails
+THUMBNAIL_PEER_WORKERS = 20
+THUMBNAIL_PEER_QUEUE_LIMIT = 200
+
+# keep-alive connections to INNER_FILE_SERVER_ROOT, per process
+FILE_SERVER_MAX_CONNECTIONS = 10
+FILE_SERVER_TIMEOUT = 30  # seconds
+FILE_SERVER_RETRIES = 2
@@ -0,0 +1,34 @@
+import asyncio
+
+
+class SingleFlight(object):
+    """ Run one call per key at a time, concurrent callers of the same key
+    wait for the call in flight and share its result (or exception).
+    """
+    def __init__(self):
+        self.flights = {}
+
+    async def run(self, key, func, *args, **kwargs):
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = asyncio.ensure_future(func(*args, **kwargs))
+            self.flights[key] = flight
+            flight.add_done_callback(lambda f: self.finish(key, f))
+
+        # a waiter going away (client disconnected) must not cancel the
+        # generation the other waiters are sharing
+        return await asyncio.shield(flight)
+
+    def finish(self, key, flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+        if not flight.cancelled():
+            # mark the exception as retrieved when every waiter has gone
+            flight.exception()
+
+    def in_flight(self):
+        return len(self.flights)
+
+
+# keyed on (file_id, size)
+thumbnail_flights = SingleFlight()
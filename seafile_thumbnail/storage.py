@@ -0,0 +1,272 @@
+""" Where generated thumbnails are stored.
+
+Every node serves thumbnails from its own THUMBNAIL_DIR (LocalStorage), the
+thumbnail index and the disk cache GC work on it. With THUMBNAIL_STORAGE
+'nfs' or 's3' the thumbnails are also written to a storage shared by all
+nodes, and a thumbnail missing locally is copied from there before it is
+generated. THUMBNAIL_DIR is a read-through tier in front of the shared
+storage, a thumbnail is generated once for all nodes.
+
+The GC only removes local copies, thumbnails in the shared storage are
+removed by its own means, e.g. an S3 lifecycle rule.
+
+Backends store the thumbnail of (file_id, size) with read(), write() and
+delete(), read() returns None if there is none.
+
+Lookups in the shared storage run in the io threads that serve cached
+thumbnails. A miss there is remembered for THUMBNAIL_STORAGE_MISS_TTL
+seconds, and a failing shared storage is skipped for
+THUMBNAIL_STORAGE_RETRY_INTERVAL seconds, so an outage does not hold the io
+threads in timeouts. The generation of a missing thumbnail does not look it
+up again.
+"""
+import os
+import time
+import errno
+import logging
+
+from seafile_thumbnail import settings
+from seafile_thumbnail.utils import get_thumbnail_path, write_file_atomic
+from seafile_thumbnail.thumbnail_index import thumbnail_index
+from seafile_thumbnail.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class LocalStorage(object):
+    """ thumbnails under THUMBNAIL_DIR, looked up in the thumbnail index """
+    def __init__(self, index):
+        self.index = index
+
+    def find(self, file_id, size, local=False):
+        """ the index entry of the thumbnail, or None. `local` only looks
+        in THUMBNAIL_DIR, not in a shared storage behind it.
+        """
+        return self.index.find(file_id, size)
+
+    def open(self, file_id, size, local=False):
+        """ return (file object, size) of the thumbnail, or (None, 0) """
+        entry = self.find(file_id, size, local)
+        if entry is None:
+            return None, 0
+        try:
+            f = open(entry['path'], 'rb')
+        except FileNotFoundError:
+            # removed behind the index
+            self.index.remove(file_id, size)
+            return None, 0
+        # fstat the opened file, it is the one that will be sent
+        return f, os.fstat(f.fileno()).st_size
+
+    def record_hit(self, file_id, size):
+        """ the thumbnail was served, from this storage or a copy of it """
+        self.index.record_hit(file_id, size)
+
+    def read(self, file_id, size, local=False):
+        f, _ = self.open(file_id, size, local)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def write(self, file_id, size, data):
+        thumbnail_path = get_thumbnail_path(file_id, size)
+        write_file_atomic(thumbnail_path, data)
+        self.index.add(file_id, size, thumbnail_path, len(data), settings.THUMBNAIL_EXTENSION)
+
+    def delete(self, file_id, size):
+        try:
+            os.unlink(get_thumbnail_path(file_id, size))
+        except FileNotFoundError:
+            pass
+        self.index.remove(file_id, size)
+
+    def stats(self):
+        return {'remote': None}
+
+
+class NFSStorage(object):
+    """ thumbnails in a directory shared by all nodes, e.g. mounted over NFS,
+    in the layout of THUMBNAIL_DIR
+
+    A thumbnail is written to a temporary file of a unique name, synced and
+    renamed into place. Rename is atomic on the server, readers on any node
+    see the whole thumbnail or none, and nothing is locked: locks over NFS
+    are unreliable and a lost one would block every node.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def read(self, file_id, size):
+        thumbnail_path = get_thumbnail_path(file_id, size, self.root)
+        # another node may replace the file while it is read, the old
+        # handle is stale then, the new file has the same content
+        for i in range(2):
+            try:
+                with open(thumbnail_path, 'rb') as f:
+                    return f.read()
+            except FileNotFoundError:
+                return None
+            except OSError as e:
+                if e.errno != errno.ESTALE:
+                    raise
+        return None
+
+    def write(self, file_id, size, data):
+        write_file_atomic(get_thumbnail_path(file_id, size, self.root), data, fsync=True)
+
+    def delete(self, file_id, size):
+        try:
+            os.unlink(get_thumbnail_path(file_id, size, self.root))
+        except FileNotFoundError:
+            pass
+
+
+class S3Storage(object):
+    """ thumbnails in an S3 compatible object storage, keyed
+    <prefix><size>/<file_id>
+
+    `client_kwargs` are passed to boto3.client('s3'), e.g. endpoint_url to
+    use MinIO or a local stand-in. Requests fail after `timeout` seconds
+    without retries, a thumbnail is generated locally rather than waited for.
+    Only s3:GetObject, s3:PutObject and s3:DeleteObject are needed.
+    """
+    def __init__(self, bucket, prefix='', timeout=5, **client_kwargs):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.timeout = timeout
+        self.client_kwargs = client_kwargs
+        self.client = None
+        self.pid = None
+
+    def get_client(self):
+        # a client is not used across fork
+        if self.client is not None and self.pid == os.getpid():
+            return self.client
+        try:
+            import boto3
+            from botocore.config import Config
+        except ImportError:
+            logger.error("Could not find boto3 installed. "
+                         "Please install by 'pip install boto3'")
+            raise
+        config = Config(connect_timeout=self.timeout, read_timeout=self.timeout,
+                        retries={'max_attempts': 0})
+        self.client = boto3.client('s3', config=config, **self.client_kwargs)
+        self.pid = os.getpid()
+        return self.client
+
+    def get_key(self, file_id, size):
+        return '%s%s/%s' % (self.prefix, size, file_id)
+
+    def read(self, file_id, size):
+        from botocore.exceptions import ClientError
+        client = self.get_client()
+        try:
+            response = client.get_object(Bucket=self.bucket, Key=self.get_key(file_id, size))
+        except ClientError as e:
+            # a missing key is 403 AccessDenied without s3:ListBucket
+            if e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') in (403, 404):
+                return None
+            raise
+        with response['Body'] as body:
+            return body.read()
+
+    def write(self, file_id, size, data):
+        self.get_client().put_object(Bucket=self.bucket, Key=self.get_key(file_id, size), Body=data,
+                                     ContentType='image/%s' % settings.THUMBNAIL_EXTENSION)
+
+    def delete(self, file_id, size):
+        self.get_client().delete_object(Bucket=self.bucket, Key=self.get_key(file_id, size))
+
+
+class TieredStorage(LocalStorage):
+    """ LocalStorage in front of the `remote` backend shared by all nodes
+
+    A thumbnail missing locally is copied from `remote`, new thumbnails are
+    written to both. A thumbnail missing in `remote` is not looked up there
+    again for `miss_ttl` seconds. An error of `remote` is logged and
+    `remote` is skipped for `retry_interval` seconds, thumbnails are
+    generated and served locally then.
+    """
+    def __init__(self, index, remote, miss_ttl, miss_cache_size, retry_interval):
+        super(TieredStorage, self).__init__(index)
+        self.remote = remote
+        self.misses = TTLCache(miss_cache_size, miss_ttl)
+        self.retry_interval = retry_interval
+        # time.monotonic() remote is skipped until
+        self.down_until = 0
+        self.remote_hits = 0
+        self.remote_misses = 0
+        self.remote_errors = 0
+
+    def is_down(self):
+        return self.down_until > time.monotonic()
+
+    def set_down(self, action, file_id, size, e):
+        self.remote_errors += 1
+        self.down_until = time.monotonic() + self.retry_interval
+        logger.warning('Failed to %s thumbnail %s/%s with %s, skip it for %s seconds: %s' % (
+            action, size, file_id, type(self.remote).__name__, self.retry_interval, e))
+
+    def find(self, file_id, size, local=False):
+        entry = super(TieredStorage, self).find(file_id, size)
+        if entry is not None or local or self.is_down() or self.misses.get((file_id, size)):
+            return entry
+        try:
+            data = self.remote.read(file_id, size)
+        except Exception as e:
+            self.set_down('read', file_id, size, e)
+            return None
+        if data is None:
+            self.remote_misses += 1
+            self.misses.set((file_id, size), True)
+            return None
+        self.remote_hits += 1
+        super(TieredStorage, self).write(file_id, size, data)
+        return super(TieredStorage, self).find(file_id, size)
+
+    def write(self, file_id, size, data):
+        super(TieredStorage, self).write(file_id, size, data)
+        self.misses.delete((file_id, size))
+        if self.is_down():
+            return
+        try:
+            self.remote.write(file_id, size, data)
+        except Exception as e:
+            self.set_down('write', file_id, size, e)
+
+    def delete(self, file_id, size):
+        super(TieredStorage, self).delete(file_id, size)
+        if self.is_down():
+            return
+        try:
+            self.remote.delete(file_id, size)
+        except Exception as e:
+            self.set_down('delete', file_id, size, e)
+
+    def stats(self):
+        return {
+            'remote': type(self.remote).__name__,
+            'remote_down': self.is_down(),
+            'remote_hits': self.remote_hits,
+            'remote_misses': self.remote_misses,
+            'remote_errors': self.remote_errors,
+            'remote_miss_cache': self.misses.stats(),
+        }
+
+
+def get_storage():
+    if settings.THUMBNAIL_STORAGE == 'local':
+        return LocalStorage(thumbnail_index)
+    if settings.THUMBNAIL_STORAGE == 'nfs':
+        remote = NFSStorage(settings.THUMBNAIL_NFS_DIR)
+    elif settings.THUMBNAIL_STORAGE == 's3':
+        remote = S3Storage(**settings.THUMBNAIL_S3)
+    else:
+        raise ValueError('Unknown THUMBNAIL_STORAGE %s' % settings.THUMBNAIL_STORAGE)
+    return TieredStorage(thumbnail_index, remote, settings.THUMBNAIL_STORAGE_MISS_TTL,
+                         settings.THUMBNAIL_STORAGE_MISS_CACHE_SIZE, settings.THUMBNAIL_STORAGE_RETRY_INTERVAL)
+
+
+thumbnail_storage = get_storage()
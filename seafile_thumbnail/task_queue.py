@@ -1,110 +1,146 @@
-# import queue
-# import threading
-# import logging
-# import time
-# import uuid
-# from seafevents.seafevent_server.utils import export_event_log_to_excel, export_org_event_log_to_excel
-#
-# logger = logging.getLogger(__name__)
-#
-#
-# class ThumbnailManager(object):
-#
-#     def __init__(self):
-#         self.app = None
-#         self.tasks_map = {}
-#         self.task_results_map = {}
-#         self.image_queue = queue.Queue(10)
-#         self.video_queue = queue.Queue(10)
-#         self.current_task_info = {}
-#         self.threads = []
-#         self.conf = {
-#             'workers': 3,
-#             'expire_time': 30 * 60
-#         }
-#
-#     def init(self, app, workers, task_expire_time, config):
-#         self.app = app
-#         self.conf['expire_time'] = task_expire_time
-#         self.conf['workers'] = workers
-#
-#     def is_valid_task_id(self, task_id):
-#         return task_id in (self.tasks_map.keys() | self.task_results_map.keys())
-#
-#     def add_image_creat_task(self, start_time, end_time, log_type):
-#         task_id = str(uuid.uuid4())
-#         task = (export_event_log_to_excel, (start_time, end_time, log_type, task_id))
-#
-#         self.tasks_queue.put(task_id)
-#         self.tasks_map[task_id] = task
-#         return task_id
-#
-#     def add_video_task(self, start_time, end_time, log_type, org_id):
-#         task_id = str(uuid.uuid4())
-#         task = (export_org_event_log_to_excel, (start_time, end_time, log_type, task_id, org_id))
-#
-#         self.tasks_queue.put(task_id)
-#         self.tasks_map[task_id] = task
-#         return task_id
-#
-#     def query_status(self, task_id):
-#         task_result = self.task_results_map.pop(task_id, None)
-#         if task_result == 'success':
-#             return True, None
-#         if isinstance(task_result, str) and task_result.startswith('error_'):
-#             return True, task_result[6:]
-#         return False, None
-#
-#     def threads_is_alive(self):
-#         info = {}
-#         for t in self.threads:
-#             info[t.name] = t.is_alive()
-#         return info
-#
-#     def handle_task(self):
-#         while True:
-#             try:
-#                 image_id = self.image_queue.get(timeout=2)
-#                 # video_id = self.video_queue.get(timeout=2)
-#             except queue.Empty:
-#                 continue
-#             except Exception as e:
-#                 logger.error(e)
-#                 continue
-#             task = self.tasks_map.get(image_id)
-#             if type(task) != tuple or len(task) < 1:
-#                 continue
-#             if type(task[0]).__name__ != 'function':
-#                 continue
-#             task_info = image_id + ' ' + str(task[0])
-#             try:
-#                 self.current_task_info[image_id] = task_info
-#                 logging.info('Run task: %s' % task_info)
-#                 start_time = time.time()
-#
-#                 # run
-#                 task[0](*task[1])
-#                 self.task_results_map[image_id] = 'success'
-#
-#                 finish_time = time.time()
-#                 logging.info('Run task success: %s cost %ds \n' % (task_info, int(finish_time - start_time)))
-#                 self.current_task_info.pop(image_id, None)
-#             except Exception as e:
-#                 self.task_results_map[image_id] = 'error_' + str(e.args[0])
-#                 logger.exception(e)
-#                 logger.error('Failed to handle task %s, error: %s \n' % (task_info, e))
-#                 self.current_task_info.pop(image_id, None)
-#             finally:
-#                 self.tasks_map.pop(image_id, None)
-#
-#     def run(self):
-#         thread_num = self.conf['workers']
-#         for i in range(thread_num):
-#             t_name = 'TaskManager Thread-' + str(i)
-#             t = threading.Thread(target=self.handle_task, name=t_name)
-#             self.threads.append(t)
-#             t.setDaemon(True)
-#             t.start()
-#
-#
-# thumbnail_task_manager = ThumbnailManager()
+import time
+import asyncio
+import hashlib
+import logging
+import itertools
+
+from seafile_thumbnail import settings
+from seafile_thumbnail.constants import IMAGE, VIDEO, PDF
+from seafile_thumbnail.executor import Stage, process_pool, io_stage
+from seafile_thumbnail.thumbnail_index import thumbnail_index
+
+logger = logging.getLogger(__name__)
+
+# a thumbnail somebody is looking at goes before one created in advance
+PRIORITY_VIEW = 0
+PRIORITY_CREATE = 1
+
+
+class ThumbnailManager(object):
+    """ Generates thumbnails of slow file types in the background.
+
+    Every task type has its own priority queue, worker coroutines and
+    process pool, so a burst of videos does not hold up PDFs and no
+    request waits for a generation. Only used from the event loop thread.
+
+    The task id is derived from (file_id, size), and the task status is kept
+    in the thumbnail index shared by the server processes of the node. A
+    thumbnail is queued by one process, and any process answers its status.
+    """
+    def __init__(self, queues_conf, task_expire_time):
+        self.app = None
+        self.task_id_prefix = ''
+        self.queues_conf = queues_conf
+        self.task_expire_time = task_expire_time
+        self.queues = {}
+        self.stages = {}
+        self.workers = []
+        # task_id of every (file_id, size) queued by this process
+        self.key_tasks = {}
+        self.counter = itertools.count()
+
+    def init(self, app, task_id_prefix=''):
+        self.app = app
+        self.task_id_prefix = task_id_prefix
+
+    def get_task_type(self, thumbnail_info):
+        """ the queue for the thumbnail, None if it is generated right away """
+        if not settings.ENABLE_ASYNC_THUMBNAIL:
+            return None
+        file_type = thumbnail_info['file_type']
+        if file_type == VIDEO:
+            task_type = 'video'
+        elif file_type == PDF:
+            task_type = 'pdf'
+        elif file_type == IMAGE and thumbnail_info['file_ext'].lower() == 'psd':
+            task_type = 'psd'
+        else:
+            return None
+        return task_type if task_type in self.queues_conf else None
+
+    def get_task_id(self, key):
+        task_id = hashlib.md5(('%s:%s' % key).encode('utf-8')).hexdigest()
+        return self.task_id_prefix + task_id[len(self.task_id_prefix):]
+
+    async def add_task(self, task_type, thumbnail_info, priority):
+        """ queue the generation of the thumbnail and return the task id, a
+        thumbnail already queued by any process is not queued again
+        """
+        self.run()
+        key = (thumbnail_info['file_id'], int(thumbnail_info['size']))
+        task_id = self.get_task_id(key)
+        if key in self.key_tasks:
+            return task_id
+        stale_before = time.time() - self.task_expire_time
+        if not await io_stage.run(thumbnail_index.claim_task, task_id, key[0], key[1], stale_before):
+            return task_id
+
+        try:
+            self.queues[task_type].put_nowait((priority, next(self.counter), task_id, thumbnail_info))
+        except asyncio.QueueFull:
+            logger.warning('%s thumbnail queue is full.' % task_type)
+            await io_stage.run(thumbnail_index.remove_task, task_id)
+            raise AssertionError(503, 'Server busy.')
+        self.key_tasks[key] = task_id
+        return task_id
+
+    def query_status(self, task_id):
+        """ the status of the task, blocking, run it in the io stage """
+        task = thumbnail_index.get_task(task_id)
+        if task is None:
+            raise AssertionError(404, 'Task not found.')
+        return {
+            'task_id': task_id,
+            'status': task['status'],
+            'error': task['error'],
+        }
+
+    async def handle_task(self, task_type):
+        task_queue = self.queues[task_type]
+        stage = self.stages[task_type]
+        while True:
+            priority, _, task_id, thumbnail_info = await task_queue.get()
+            start_time = time.monotonic()
+            status, error = 'success', None
+            try:
+                await io_stage.run(thumbnail_index.set_task_status, task_id, 'running')
+                await self.app.generate_thumbnail(thumbnail_info, stage)
+                logger.info('Run %s thumbnail task %s success, cost %.3fs.' % (
+                    task_type, task_id, time.monotonic() - start_time))
+            except Exception as e:
+                if isinstance(e, AssertionError) and len(e.args) == 2:
+                    error = e.args[1]
+                else:
+                    logger.exception(e)
+                    error = 'Internal server error.'
+                status = 'error'
+                logger.warning('Failed to run %s thumbnail task %s: %s' % (task_type, task_id, error))
+            try:
+                await io_stage.run(thumbnail_index.set_task_status, task_id, status, error)
+                await io_stage.run(thumbnail_index.expire_tasks, time.time() - self.task_expire_time)
+            except Exception as e:
+                logger.warning('Failed to update thumbnail task %s: %s' % (task_id, e))
+            finally:
+                self.key_tasks.pop((thumbnail_info['file_id'], int(thumbnail_info['size'])), None)
+                task_queue.task_done()
+
+    def run(self):
+        # started on first use, the queues belong to the running event loop
+        if self.workers:
+            return
+        for task_type, (workers, queue_size) in self.queues_conf.items():
+            self.queues[task_type] = asyncio.PriorityQueue(queue_size)
+            self.stages[task_type] = Stage(task_type, process_pool, workers, workers)
+            for i in range(workers):
+                self.workers.append(asyncio.ensure_future(self.handle_task(task_type)))
+
+    def stats(self):
+        return {
+            task_type: {
+                'queued': self.queues[task_type].qsize(),
+                'stage': self.stages[task_type].stats(),
+            } for task_type in self.queues
+        }
+
+
+thumbnail_task_manager = ThumbnailManager(settings.THUMBNAIL_TASK_QUEUES, settings.THUMBNAIL_TASK_EXPIRE_TIME)
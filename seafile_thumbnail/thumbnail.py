@@ -1,26 +1,25 @@
 import logging
 import os
-import tempfile
 import timeit
 import zipfile
-import urllib.request, urllib.error, urllib.parse
+import functools
 from io import BytesIO
-from fitz import open as fitz_open
-from PIL import Image
+from PIL import Image, ImageFile
 
 from seafile_thumbnail import settings
 from seafile_thumbnail.utils import get_inner_path
+from seafile_thumbnail.metadata import metadata_cache
+from seafile_thumbnail.fileserver import fileserver
+from seafile_thumbnail.storage import thumbnail_storage
+from seafile_thumbnail.cache import InvalidFileError
+from seafile_thumbnail.video import extract_video_frame
+from seafile_thumbnail.pdf import read_pdf, render_first_page
+from seafile_thumbnail.psd import get_embedded_thumbnail, decode_composite
+from seafile_thumbnail.heif import open_heif
 from seafile_thumbnail.constants import VIDEO, PDF, XMIND, EMPTY_BYTES
-from seafile_thumbnail.settings import ENABLE_VIDEO_THUMBNAIL, THUMBNAIL_IMAGE_SIZE_LIMIT, THUMBNAIL_ROOT, \
+from seafile_thumbnail.settings import ENABLE_VIDEO_THUMBNAIL, THUMBNAIL_IMAGE_SIZE_LIMIT, \
     THUMBNAIL_IMAGE_ORIGINAL_SIZE_LIMIT, THUMBNAIL_EXTENSION
 
-from seaserv import get_repo, get_file_size, seafile_api
-
-try:  # Py2 and Py3 compatibility
-    from urllib.request import urlretrieve
-except:
-    from urllib.request import urlretrieve
-
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 handler = logging.StreamHandler()
@@ -28,7 +27,29 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(messag
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
-XMIND_IMAGE_SIZE = 1024
+# a partial image not identified after this many bytes is opened when complete
+IMAGE_HEADER_SIZE_LIMIT = 1024 ** 2
+
+
+@functools.lru_cache(maxsize=8)
+def get_placeholder(size):
+    """ a transparent PNG square of `size`, shown by an <img> while its
+    thumbnail is generated in the background
+    """
+    size = max(1, min(size, max(settings.THUMBNAIL_SIZES)))
+    byte_io = BytesIO()
+    Image.new('RGBA', (size, size)).save(byte_io, 'PNG', optimize=True)
+    return byte_io.getvalue()
+
+
+def generate_thumbnail(info):
+    """ entry point of render workers, return the thumbnail body
+
+    `info` is the `thumbnail_info` of ThumbnailSerializer, it is pickled to
+    the worker process.
+    """
+    thumbnail = Thumbnail(**info)
+    return thumbnail.body
 
 
 # =================Thumbnail================
@@ -39,22 +60,27 @@ class Thumbnail(object):
         self.get()
 
     def get(self):
-        if os.path.exists(self.thumbnail_path):
-            with open(self.thumbnail_path, 'rb') as f:
-                self.body = f.read()
-
+        # the server looked in the shared storage before generating
+        body = thumbnail_storage.read(self.file_id, int(self.size), local=True)
+        if body is not None:
+            self.body = body
         else:
             self.generate_thumbnail()
 
-    def get_rotated_image(self, image):
+    def get_image_orientation(self, image):
 
         # get image's exif info
         try:
             exif = image._getexif() if image._getexif() else {}
         except Exception:
-            return image
+            return 1
 
-        orientation = exif.get(0x0112) if isinstance(exif, dict) else 1
+        return exif.get(0x0112) if isinstance(exif, dict) else 1
+
+    def get_rotated_image(self, image, orientation=None):
+
+        if orientation is None:
+            orientation = self.get_image_orientation(image)
         # rotate image according to Orientation info
 
         # im.transpose(method)
@@ -113,29 +139,34 @@ class Thumbnail(object):
         size = int(self.size)
         file_id = self.file_id
         file_name = self.file_name
-        thumbnail_file = self.thumbnail_path
         if self.file_type == VIDEO and not ENABLE_VIDEO_THUMBNAIL:
             raise AssertionError(400, 'not configured.')
 
-        repo = get_repo(repo_id)
-        file_size = get_file_size(repo.store_id, repo.version, file_id)
+        # derive it from a larger cached thumbnail of the same file if there
+        # is one, the original is not needed then
+        larger_size, larger_thumbnail = self.get_larger_thumbnail(size)
+        if larger_thumbnail:
+            self._create_thumbnail_common(larger_thumbnail, size,
+                                          max_size=larger_size)
+            return
+
+        repo = metadata_cache.get_repo(repo_id)
+        file_size = metadata_cache.get_file_size(repo, file_id)
 
         if self.file_type == VIDEO:
             # video thumbnails
             if ENABLE_VIDEO_THUMBNAIL:
-                self.create_video_thumbnails(repo, file_id, path, size,
-                                             thumbnail_file, file_size)
+                self.create_video_thumbnails(repo, file_id, path, size, file_size)
             else:
                 raise AssertionError(400, 'not configured.')
             return
         if self.file_type == PDF:
             # pdf thumbnails
-            self.create_pdf_thumbnails(repo, file_id, path, size,
-                                       thumbnail_file, file_size)
+            self.create_pdf_thumbnails(repo, file_id, path, size, file_size)
             return
 
         if self.file_type == XMIND:
-            self.extract_xmind_image(repo_id, size)
+            self.extract_xmind_image(repo_id, size, file_size)
             return
 
         # image thumbnails
@@ -143,155 +174,302 @@ class Thumbnail(object):
             raise AssertionError(400, 'file_size invalid.')
 
         if self.file_ext.lower() == 'psd':
-            self.create_psd_thumbnails(repo, file_id, path, size,
-                                       thumbnail_file, file_size)
+            self.create_psd_thumbnails(repo, file_id, path, size, file_size)
+            return
+
+        if self.file_ext.lower() in ('heic', 'heif'):
+            self.create_heif_thumbnails(repo, file_id, path, size, file_size)
             return
 
         # image thumbnail
         inner_path = get_inner_path(repo_id, file_id, file_name)
         try:
-            image_file = urllib.request.urlopen(inner_path)
-            f = BytesIO(image_file.read())
-            self._create_thumbnail_common(f, thumbnail_file, size)
+            with fileserver.open(inner_path) as response:
+                f = self.decode_image_stream(response)
+            self._create_thumbnail_common(f, size)
             return
+        except AssertionError as e:
+            logger.warning(e)
+            raise
         except Exception as e:
             logger.warning(e)
-            raise AssertionError(500, 'Internal server error.')
+            raise InvalidFileError(500, 'Internal server error.')
+
+    def decode_image_stream(self, response):
+        """ Decode the image while it is downloaded from the fileserver.
+
+        The image size is checked as soon as the header is received, an
+        oversized image is rejected after a few KB. Formats PIL can decode
+        incrementally are fed chunk by chunk to an ImageFile.Parser and the
+        decoded image is returned, the compressed file is never held in
+        memory. Other formats (e.g. JPEG, PNG) are returned as a file object,
+        so that _create_thumbnail_common can still decode them at reduced
+        scale.
+        """
+        chunks = response.iter_chunks()
+        head = bytearray()
+        image = None
+        next_try = 0
+        for chunk in chunks:
+            head += chunk
+            if len(head) < next_try:
+                continue
+            try:
+                image = Image.open(BytesIO(head))
+                break
+            except OSError:
+                # not enough data yet, try again with twice as much
+                next_try = 2 * len(head)
+                if len(head) > IMAGE_HEADER_SIZE_LIMIT:
+                    break
+        if image is None:
+            # the header is large or at the end of the file (e.g. TIFF), open
+            # the whole file, its size was checked against
+            # THUMBNAIL_IMAGE_SIZE_LIMIT
+            for chunk in chunks:
+                head += chunk
+            try:
+                image = Image.open(BytesIO(head))
+            except OSError:
+                raise InvalidFileError(500, 'Image can not be identified.')
+        head = bytes(head)
+
+        self.check_image_size(image)
+
+        incremental = len(image.tile) == 1 and \
+            not hasattr(image, 'load_read') and not hasattr(image, 'load_seek')
+        if not incremental:
+            f = BytesIO(head)
+            f.seek(0, os.SEEK_END)
+            for chunk in chunks:
+                f.write(chunk)
+            f.seek(0)
+            return f
+
+        parser = ImageFile.Parser()
+        parser.feed(head)
+        for chunk in chunks:
+            parser.feed(chunk)
+        return parser.close()
+
+    def check_image_size(self, image):
+        # check image memory cost size limit
+        # use RGBA as default mode(4x8-bit pixels, true colour with transparency mask)
+        # every pixel will cost 4 byte in RGBA mode
+        width, height = image.size
+        image_memory_cost = width * height * 4 / 1024 / 1024
 
-    def create_psd_thumbnails(self, repo, file_id, path, size, thumbnail_file, file_size):
+        if image_memory_cost > THUMBNAIL_IMAGE_ORIGINAL_SIZE_LIMIT:
+            raise InvalidFileError(500, 'Thumbnail original size limit.')
+
+    def create_psd_thumbnails(self, repo, file_id, path, size, file_size):
+        t1 = timeit.default_timer()
+        inner_path = get_inner_path(repo.id, file_id, self.file_name)
+        # only the header, the image resources and the composite are read,
+        # the layers are skipped
+        f = fileserver.open_range_file(inner_path, file_size)
+        try:
+            try:
+                image = Image.open(f, formats=['PSD'])
+            except Exception as e:
+                # PSB and 16/32 bit PSD
+                logger.info('Open psd [%s] with PIL fails: %s' % (path, e))
+                image = self.open_psd_with_psd_tools(f)
+            else:
+                self.check_image_size(image)
+                thumbnail = get_embedded_thumbnail(image)
+                if thumbnail and max(thumbnail.size) >= min(size, max(image.size)):
+                    logger.debug('Use embedded thumbnail of psd [%s].' % path)
+                    self._create_thumbnail_common(thumbnail, size,
+                                                  max_size=max(thumbnail.size) + 1)
+                    return
+                image = decode_composite(f, image, self.get_thumbnail_sizes(size)[0])
+
+            t2 = timeit.default_timer()
+            logger.debug('Extract psd image [%s](size: %s) reads %s bytes, takes: %s' % (
+                path, file_size, f.raw.bytes_read, (t2 - t1)))
+            self._create_thumbnail_common(image, size)
+        except AssertionError:
+            raise
+        except Exception as e:
+            logger.error(e)
+            raise InvalidFileError(500, 'Internal server error.')
+        finally:
+            f.close()
+
+    def open_psd_with_psd_tools(self, f):
         try:
             from psd_tools import PSDImage
         except ImportError:
             logger.error("Could not find psd_tools installed. "
                          "Please install by 'pip install psd_tools'")
             raise AssertionError(500, 'Internal server error.')
+        f.seek(0)
+        return PSDImage.open(f).topil()
 
-        tmp_img_path = str(os.path.join(tempfile.gettempdir(), '%s.png' % file_id))
+    def create_heif_thumbnails(self, repo, file_id, path, size, file_size):
         t1 = timeit.default_timer()
-
         inner_path = get_inner_path(repo.id, file_id, self.file_name)
-
-        tmp_file = os.path.join(tempfile.gettempdir(), file_id)
-        urlretrieve(inner_path, tmp_file)
-        psd = PSDImage.open(tmp_file)
-
-        merged_image = psd.topil()
-        merged_image.save(tmp_img_path)
-        os.unlink(tmp_file)  # remove origin psd file
-
-        t2 = timeit.default_timer()
-        logger.debug('Extract psd image [%s](size: %s) takes: %s' % (path, file_size, (t2 - t1)))
-
         try:
-            self._create_thumbnail_common(tmp_img_path, thumbnail_file, size)
-            os.unlink(tmp_img_path)
-            return
+            # libheif reads the container from memory
+            image, orientation = open_heif(fileserver.read(inner_path), self.check_image_size)
+            # with pillow_heif, draft() in _create_thumbnail_common picks an
+            # embedded thumbnail not smaller than the largest size to generate
+            self._create_thumbnail_common(image, size, orientation=orientation)
+        except AssertionError:
+            raise
+        except ImportError as e:
+            logger.error("Could not find pillow_heif or pyheif installed: %s" % e)
+            raise AssertionError(500, 'Internal server error.')
         except Exception as e:
             logger.error(e)
-            os.unlink(tmp_img_path)
-            raise AssertionError(500, 'Internal server error.')
+            raise InvalidFileError(500, 'Internal server error.')
+        t2 = timeit.default_timer()
+        logger.debug('Create HEIF image of [%s](size: %s) takes: %s' % (path, file_size, (t2 - t1)))
 
-    def create_pdf_thumbnails(self, repo, file_id, path, size, thumbnail_file, file_size):
+    def create_pdf_thumbnails(self, repo, file_id, path, size, file_size):
         t1 = timeit.default_timer()
         inner_path = get_inner_path(repo.id, file_id, self.file_name)
-
-        tmp_path = str(os.path.join(tempfile.gettempdir(), '%s.jpg' % file_id[:8]))
-        pdf_file = urllib.request.urlopen(inner_path)
-        pdf_stream = BytesIO(pdf_file.read())
+        # rendered right at the largest size to generate, no second decode
+        max_size = self.get_thumbnail_sizes(size)[0]
         try:
-            pdf_doc = fitz_open(stream=pdf_stream)
-            page = pdf_doc[0]
-            pix = page.get_pixmap()
-            pix.save(tmp_path)
+            data, complete = read_pdf(fileserver, inner_path, file_size)
+            try:
+                image = render_first_page(data, max_size, complete)
+            except Exception as e:
+                if complete:
+                    raise
+                # the first page needs more than the linearization hints say
+                logger.info('Render first page of linearized pdf [%s] fails: %s' % (path, e))
+                image = render_first_page(fileserver.read(inner_path), max_size)
+        except AssertionError:
+            raise
         except Exception as e:
             logger.error(e)
-            raise AssertionError(500, 'Internal server error.')
+            raise InvalidFileError(500, 'Internal server error.')
         t2 = timeit.default_timer()
         logger.debug('Create PDF image of [%s](size: %s) takes: %s' % (path, file_size, (t2 - t1)))
 
         try:
-            self._create_thumbnail_common(tmp_path, thumbnail_file, size)
-            pdf_stream.close()
-            pdf_doc.close()
-            os.unlink(tmp_path)
+            self._create_thumbnail_common(image, size)
             return
+        except AssertionError:
+            raise
         except Exception as e:
             logger.error(e)
-            pdf_stream.close()
-            pdf_doc.close()
-            os.unlink(tmp_path)
-            raise AssertionError(500, 'Internal server error.')
+            raise InvalidFileError(500, 'Internal server error.')
 
-    def create_video_thumbnails(self, repo, file_id, path, size, thumbnail_file, file_size):
-        from moviepy.editor import VideoFileClip
+    def create_video_thumbnails(self, repo, file_id, path, size, file_size):
         t1 = timeit.default_timer()
-        tmp_image_path = os.path.join(
-            tempfile.gettempdir(), file_id + '.png')
-        tmp_video = os.path.join(tempfile.gettempdir(), file_id)
         inner_path = get_inner_path(repo.id, file_id, self.file_name)
-        urllib.request.urlretrieve(inner_path, tmp_video)
-        clip = VideoFileClip(tmp_video)
-        clip.save_frame(
-            tmp_image_path, t=settings.THUMBNAIL_VIDEO_FRAME_TIME)
+        # ffmpeg reads the video with range requests, it is not downloaded
+        frame = extract_video_frame(fileserver, inner_path, self.get_thumbnail_sizes(size)[0])
         t2 = timeit.default_timer()
         logger.debug('Create Video image of [%s](size: %s) takes: %s' % (path, file_size, (t2 - t1)))
         try:
-            self._create_thumbnail_common(tmp_image_path, thumbnail_file, size)
-            os.unlink(tmp_image_path)
+            self._create_thumbnail_common(BytesIO(frame), size)
             return
+        except AssertionError:
+            raise
         except Exception as e:
             logger.error(e)
-            os.unlink(tmp_image_path)
-            raise AssertionError(500, 'Internal server error.')
+            raise InvalidFileError(500, 'Internal server error.')
 
-    def _create_thumbnail_common(self, fp, thumbnail_file, size):
+    def get_larger_thumbnail(self, size):
+        """ return (size, path) of the smallest cached thumbnail larger than
+        `size`, or (None, None)
+        """
+        # one lookup for all sizes, only the chosen one is checked on disk
+        indexed_sizes = thumbnail_storage.index.get_sizes(self.file_id)
+        for larger_size in sorted(settings.THUMBNAIL_SIZES):
+            if larger_size <= size or larger_size not in indexed_sizes:
+                continue
+            thumbnail_path = indexed_sizes[larger_size]
+            if os.path.exists(thumbnail_path):
+                return larger_size, thumbnail_path
+            thumbnail_storage.index.remove(self.file_id, larger_size)
+        return None, None
+
+    def get_thumbnail_sizes(self, size, max_size=None):
+        """ sizes to generate along with `size`, largest first """
+        sizes = {size}
+        if settings.THUMBNAIL_GENERATE_ALL_SIZES:
+            sizes.update(s for s in settings.THUMBNAIL_SIZES if max_size is None or s < max_size)
+        return sorted(sizes, reverse=True)
+
+    def _create_thumbnail_common(self, fp, size, max_size=None, orientation=None):
         """Common logic for creating image thumbnail.
 
-        `fp` can be a filename (string) or a file object.
+        `fp` can be a filename (string), a file object or a decoded image.
+        With THUMBNAIL_GENERATE_ALL_SIZES, the other sizes of THUMBNAIL_SIZES
+        (below `max_size` if given) are made from the same decoded image.
+        `orientation` is read from the image's EXIF if not given.
         """
-        image = Image.open(fp)
-        # check image memory cost size limit
-        # use RGBA as default mode(4x8-bit pixels, true colour with transparency mask)
-        # every pixel will cost 4 byte in RGBA mode
-        width, height = image.size
-        image_memory_cost = width * height * 4 / 1024 / 1024
-
-        if image_memory_cost > THUMBNAIL_IMAGE_ORIGINAL_SIZE_LIMIT:
-            raise AssertionError(500, 'Thumbnail original size limit.')
+        sizes = self.get_thumbnail_sizes(size, max_size)
+        # Image.open only reads the header, no pixel is decoded before the
+        # size limit is checked
+        image = fp if isinstance(fp, Image.Image) else Image.open(fp)
+        self.check_image_size(image)
+
+        # converted images lose their exif, read the orientation first
+        if orientation is None:
+            orientation = self.get_image_orientation(image)
+
+        # let the decoder scale the image down while decoding it (JPEG decodes
+        # at 1/2, 1/4 or 1/8 scale), to the smallest scale not below `size`.
+        # It is a no-op for formats without reduced scale decoding, those are
+        # reduced by image.thumbnail() right after loading.
+        image.draft(None, (sizes[0], sizes[0]))
 
         if image.mode not in ["1", "L", "P", "RGB"]:
             image = image.convert("RGB")
 
-        image = self.get_rotated_image(image)
-        image.thumbnail((size, size), Image.Resampling.LANCZOS)
-        image.save(thumbnail_file, THUMBNAIL_EXTENSION)
-        # PIL to bytes
-        byte_io = BytesIO()
-        image.save(byte_io, format='JPEG')
-        self.body = byte_io.read()
-
-    def extract_xmind_image(self, repo_id, size=XMIND_IMAGE_SIZE):
-        # get inner path
+        # rotate the small image, not the decoded one
+        image.thumbnail((sizes[0], sizes[0]), Image.Resampling.LANCZOS)
+        image = self.get_rotated_image(image, orientation)
+
+        # every smaller size is resized from the previous one. Only the local
+        # cache is checked for the other sizes, not the shared storage
+        for thumbnail_size in sizes:
+            if thumbnail_size != size and thumbnail_storage.index.find(self.file_id, thumbnail_size):
+                continue
+
+            image.thumbnail((thumbnail_size, thumbnail_size), Image.Resampling.LANCZOS)
+            # PIL to bytes, encode once for both the response and the cache file
+            byte_io = BytesIO()
+            image.save(byte_io, THUMBNAIL_EXTENSION)
+            body = byte_io.getvalue()
+            try:
+                thumbnail_storage.write(self.file_id, thumbnail_size, body)
+            except Exception as e:
+                logger.error('Failed to store thumbnail %s/%s: %s' % (thumbnail_size, self.file_id, e))
+                raise AssertionError(500, 'Internal server error.')
+            if thumbnail_size == size:
+                self.body = body
+
+    def extract_xmind_image(self, repo_id, size, file_size):
         inner_path = get_inner_path(repo_id, self.file_id, self.file_name)
-        # extract xmind image
-        xmind_file = urllib.request.urlopen(inner_path)
-        xmind_file_str = BytesIO(xmind_file.read())
+        # zipfile seeks to the central directory at the end and then to the
+        # one member, only those are read from the fileserver
+        xmind_file = fileserver.open_range_file(inner_path, file_size)
         try:
-            xmind_zip_file = zipfile.ZipFile(xmind_file_str, 'r')
+            with zipfile.ZipFile(xmind_file, 'r') as xmind_zip_file:
+                extracted_xmind_image = xmind_zip_file.read('Thumbnails/thumbnail.png')
+            logger.debug('Extract xmind image reads %s of %s bytes.' % (
+                xmind_file.raw.bytes_read, file_size))
+        except AssertionError:
+            raise
         except Exception as e:
             logger.error(e)
-            raise AssertionError(500, 'Internal server error.')
-        extracted_xmind_image = xmind_zip_file.read('Thumbnails/thumbnail.png')
-        extracted_xmind_image_str = BytesIO(extracted_xmind_image)
-
-        # save origin xmind image to thumbnail folder
-        thumbnail_dir = os.path.join(THUMBNAIL_ROOT, str(size))
-        if not os.path.exists(thumbnail_dir):
-            os.makedirs(thumbnail_dir)
-        local_xmind_image = os.path.join(thumbnail_dir, self.file_id)
+            raise InvalidFileError(500, 'Internal server error.')
+        finally:
+            xmind_file.close()
+
         try:
-            self._create_thumbnail_common(extracted_xmind_image_str, local_xmind_image, size)
+            self._create_thumbnail_common(BytesIO(extracted_xmind_image), size)
             return
+        except AssertionError:
+            raise
         except Exception as e:
             logger.error(e)
-            raise AssertionError(500, 'Internal server error.')
+            raise InvalidFileError(500, 'Internal server error.')
@@ -0,0 +1,402 @@
+""" Index of the thumbnails under THUMBNAIL_DIR.
+
+(file_id, size) -> (path, length, created, last_hit, format) is kept in a
+SQLite database in WAL mode, readers of all processes do not block the
+writer. Finding a cached thumbnail is one indexed lookup instead of stat
+calls, and the disk cache GC and stats do not walk the directory tree.
+
+The thumbnail files are the truth. The index is rebuilt from them when it is
+new or was corrupt (DiskCacheGC.rebuild_index), a thumbnail whose process
+died before indexing it is indexed when it is next looked up, an entry whose
+file is gone is dropped when it is opened.
+
+The status of the background thumbnail tasks (task_queue) is kept here too,
+so that any server process of the node answers a task status query.
+"""
+import os
+import time
+import fcntl
+import sqlite3
+import functools
+import logging
+import threading
+
+from seafile_thumbnail import settings
+from seafile_thumbnail.utils import get_thumbnail_path, thumbnail_exists
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS thumbnail (
+    file_id TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    length INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_hit REAL NOT NULL,
+    format TEXT NOT NULL,
+    PRIMARY KEY (file_id, size)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS thumbnail_last_hit ON thumbnail (last_hit);
+CREATE TABLE IF NOT EXISTS thumbnail_task (
+    task_id TEXT PRIMARY KEY,
+    file_id TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    updated REAL NOT NULL
+) WITHOUT ROWID;
+'''
+# PRAGMA user_version once the index was rebuilt from the thumbnail files
+BUILT_VERSION = 1
+# under THUMBNAIL_DIR, held by the disk cache GC and while a corrupt index is
+# replaced
+GC_LOCK_FILE = '.gc.lock'
+# seconds to wait for the lock to replace a corrupt index
+RESET_LOCK_TIMEOUT = 10
+# SQLITE_CORRUPT, SQLITE_NOTADB
+CORRUPT_ERRORS = (11, 26)
+
+
+def is_corrupt(e):
+    code = getattr(e, 'sqlite_errorcode', None)
+    if code is not None:
+        return code & 0xff in CORRUPT_ERRORS
+    # python < 3.11, no error code, and not e.g. 'database is locked'
+    return type(e) is sqlite3.DatabaseError and (
+        'malformed' in str(e) or 'not a database' in str(e))
+
+
+def retry_corrupt(method):
+    """ a corrupt database is replaced by a new one and the call retried
+    once, the GC rebuilds the new index from the thumbnail files
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except sqlite3.DatabaseError as e:
+            if not is_corrupt(e):
+                raise
+            self.recover(e)
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+class ThumbnailIndex(object):
+    """ Every thread opens its own connection, the database is shared by the
+    server processes and the render worker processes.
+
+    A corrupt database is replaced by a new one under the `lock_path` flock,
+    the other processes reconnect when they see the new file. The GC sets
+    `lock_held` while its process holds the flock.
+    """
+    def __init__(self, path, lock_path):
+        self.path = path
+        self.lock_path = lock_path
+        self.local = threading.local()
+        self.lock_held = False
+        # the threads of a process replace a corrupt database once
+        self.reset_lock = threading.Lock()
+        # (file_id, size) -> time of the hits not written yet
+        self.hits = {}
+        self.hits_lock = threading.Lock()
+
+    def connect(self):
+        # a connection is not used across fork, nor after the database file
+        # was replaced
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None and self.local.pid == os.getpid():
+            if self.get_inode() == self.local.inode:
+                return conn
+            conn.close()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # before opening, a file replaced meanwhile is seen on the next call
+        inode = self.get_inode()
+        try:
+            conn = self.open()
+        except sqlite3.DatabaseError as e:
+            if not is_corrupt(e):
+                raise
+            conn, inode = self.reset(e, inode)
+        self.local.conn = conn
+        self.local.pid = os.getpid()
+        self.local.inode = inode
+        return conn
+
+    def recover(self, error):
+        """ replace the database the connection of this thread found corrupt """
+        conn = getattr(self.local, 'conn', None)
+        inode = getattr(self.local, 'inode', None)
+        if conn is not None and self.local.pid == os.getpid():
+            conn.close()
+        self.local.conn = None
+        conn, inode = self.reset(error, inode)
+        self.local.conn = conn
+        self.local.pid = os.getpid()
+        self.local.inode = inode
+
+    def get_inode(self):
+        try:
+            return os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return None
+
+    def reset(self, error, inode):
+        """ replace the corrupt database of `inode` by a new one, return
+        (connection, inode of the new file)
+
+        Done under the GC lock, so that processes finding the index corrupt
+        at the same time replace it once and the GC does not rebuild it
+        meanwhile. The process of the GC holds the lock already.
+        """
+        with self.reset_lock:
+            if self.lock_held:
+                return self.replace(error, inode)
+            os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+            with open(self.lock_path, 'w') as lock_file:
+                deadline = time.monotonic() + RESET_LOCK_TIMEOUT
+                while True:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if time.monotonic() > deadline:
+                            raise error
+                        time.sleep(0.1)
+                try:
+                    return self.replace(error, inode)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def replace(self, error, inode):
+        # already replaced by another process or thread
+        if inode is None or self.get_inode() == inode:
+            logger.error('Thumbnail index %s is corrupt, it is rebuilt: %s' % (self.path, error))
+            for suffix in ('', '-wal', '-shm'):
+                try:
+                    os.unlink(self.path + suffix)
+                except FileNotFoundError:
+                    pass
+        inode = self.get_inode()
+        return self.open(), inode
+
+    def open(self):
+        # autocommit, every statement is its own transaction unless BEGIN
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        # a power loss may lose the last entries, never corrupt the index
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(SCHEMA)
+        return conn
+
+    @retry_corrupt
+    def get(self, file_id, size):
+        """ the entry of the thumbnail as a dict, or None """
+        row = self.connect().execute(
+            'SELECT path, length, created, last_hit, format FROM thumbnail '
+            'WHERE file_id = ? AND size = ?', (file_id, size)).fetchone()
+        return dict(row) if row else None
+
+    def find(self, file_id, size):
+        """ the entry of the cached thumbnail, or None if it is not generated
+        yet. A thumbnail on disk but not in the index is indexed.
+        """
+        entry = self.get(file_id, size)
+        if entry is not None:
+            return entry
+        thumbnail_path = get_thumbnail_path(file_id, size)
+        if not thumbnail_exists(thumbnail_path):
+            return None
+        try:
+            stat = os.stat(thumbnail_path)
+        except FileNotFoundError:
+            return None
+        return self.add(file_id, size, thumbnail_path, stat.st_size,
+                        settings.THUMBNAIL_EXTENSION, stat.st_mtime)
+
+    @retry_corrupt
+    def get_sizes(self, file_id):
+        """ size -> path of every indexed thumbnail of the file """
+        rows = self.connect().execute(
+            'SELECT size, path FROM thumbnail WHERE file_id = ?', (file_id,))
+        return {size: path for size, path in rows}
+
+    @retry_corrupt
+    def add(self, file_id, size, path, length, format, mtime=None):
+        """ index a written thumbnail, `mtime` is its creation and last hit
+        time, now if not given. Return the entry.
+        """
+        now = time.time() if mtime is None else mtime
+        self.connect().execute(
+            'INSERT OR REPLACE INTO thumbnail VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (file_id, size, path, length, now, now, format))
+        return {'path': path, 'length': length, 'created': now, 'last_hit': now, 'format': format}
+
+    @retry_corrupt
+    def add_many(self, entries):
+        """ index (file_id, size, path, length, format, mtime) of thumbnails
+        found on disk, the entries already there are kept
+        """
+        conn = self.connect()
+        conn.execute('BEGIN')
+        try:
+            conn.executemany(
+                'INSERT OR IGNORE INTO thumbnail VALUES (?, ?, ?, ?, ?, ?, ?)',
+                ((file_id, size, path, length, mtime, mtime, format)
+                 for file_id, size, path, length, format, mtime in entries))
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def record_hit(self, file_id, size):
+        """ mark the thumbnail as used now, it is written by flush_hits() """
+        with self.hits_lock:
+            self.hits[(file_id, size)] = time.time()
+
+    def flush_hits(self):
+        """ write the recorded hits in one transaction, return the number of
+        refreshed entries
+
+        Only last hits older than THUMBNAIL_CACHE_TOUCH_INTERVAL are
+        refreshed. The mtime of the thumbnail is set too, so a rebuilt index
+        keeps the last hits.
+        """
+        with self.hits_lock:
+            hits, self.hits = self.hits, {}
+        if not hits:
+            return 0
+        touched = self.update_hits(hits)
+        for file_id, size, hit in touched:
+            try:
+                os.utime(get_thumbnail_path(file_id, size), (hit, hit))
+            except OSError as e:
+                logger.warning('Failed to touch thumbnail %s/%s: %s' % (size, file_id, e))
+        return len(touched)
+
+    @retry_corrupt
+    def update_hits(self, hits):
+        """ set the last hits, return (file_id, size, hit) of the entries
+        refreshed
+        """
+        conn = self.connect()
+        touched = []
+        conn.execute('BEGIN')
+        try:
+            for (file_id, size), hit in hits.items():
+                cursor = conn.execute(
+                    'UPDATE thumbnail SET last_hit = ? WHERE file_id = ? AND size = ? AND last_hit < ?',
+                    (hit, file_id, size, hit - settings.THUMBNAIL_CACHE_TOUCH_INTERVAL))
+                if cursor.rowcount:
+                    touched.append((file_id, size, hit))
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return touched
+
+    @retry_corrupt
+    def remove(self, file_id, size):
+        self.connect().execute(
+            'DELETE FROM thumbnail WHERE file_id = ? AND size = ?', (file_id, size))
+
+    @retry_corrupt
+    def clear_batch(self, batch_size):
+        """ remove up to `batch_size` entries and mark the index as not
+        built, return the number removed. A batch is a short transaction, the
+        writers of other processes are not blocked for long.
+        """
+        conn = self.connect()
+        conn.execute('PRAGMA user_version = 0')
+        return conn.execute(
+            'DELETE FROM thumbnail WHERE (file_id, size) IN '
+            '(SELECT file_id, size FROM thumbnail LIMIT ?)', (batch_size,)).rowcount
+
+    @retry_corrupt
+    def claim_task(self, task_id, file_id, size, stale_before):
+        """ mark the background task pending, return False if it is pending
+        or running in some process already and was updated after
+        `stale_before`, a task of a process that died is claimed again
+        """
+        conn = self.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT status, updated FROM thumbnail_task WHERE task_id = ?', (task_id,)).fetchone()
+            claimed = not (row and row['status'] in ('pending', 'running') and row['updated'] >= stale_before)
+            if claimed:
+                conn.execute(
+                    'INSERT OR REPLACE INTO thumbnail_task VALUES (?, ?, ?, ?, ?, ?)',
+                    (task_id, file_id, size, 'pending', None, time.time()))
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return claimed
+
+    @retry_corrupt
+    def set_task_status(self, task_id, status, error=None):
+        self.connect().execute(
+            'UPDATE thumbnail_task SET status = ?, error = ?, updated = ? WHERE task_id = ?',
+            (status, error, time.time(), task_id))
+
+    @retry_corrupt
+    def get_task(self, task_id):
+        """ the task as a dict, or None """
+        row = self.connect().execute(
+            'SELECT task_id, file_id, size, status, error, updated FROM thumbnail_task '
+            'WHERE task_id = ?', (task_id,)).fetchone()
+        return dict(row) if row else None
+
+    @retry_corrupt
+    def remove_task(self, task_id):
+        self.connect().execute('DELETE FROM thumbnail_task WHERE task_id = ?', (task_id,))
+
+    @retry_corrupt
+    def expire_tasks(self, before):
+        """ remove the tasks not updated since `before` """
+        self.connect().execute('DELETE FROM thumbnail_task WHERE updated < ?', (before,))
+
+    def iter_oldest(self, batch_size):
+        """ yield (file_id, size, path, length) of all thumbnails, least
+        recently used first
+
+        Every batch is a new query, the yielded entries can be removed
+        meanwhile.
+        """
+        last = (-1.0, '', -1)
+        while True:
+            rows = self.get_oldest(last, batch_size)
+            if not rows:
+                return
+            for last_hit, file_id, size, path, length in rows:
+                yield file_id, size, path, length
+            last = tuple(rows[-1])[:3]
+
+    @retry_corrupt
+    def get_oldest(self, last, batch_size):
+        return self.connect().execute(
+            'SELECT last_hit, file_id, size, path, length FROM thumbnail '
+            'WHERE (last_hit, file_id, size) > (?, ?, ?) '
+            'ORDER BY last_hit, file_id, size LIMIT ?', last + (batch_size,)).fetchall()
+
+    @retry_corrupt
+    def totals(self):
+        """ (files, bytes) of the indexed thumbnails """
+        files, length = self.connect().execute(
+            'SELECT COUNT(*), TOTAL(length) FROM thumbnail').fetchone()
+        return files, int(length)
+
+    @retry_corrupt
+    def is_built(self):
+        return self.connect().execute('PRAGMA user_version').fetchone()[0] >= BUILT_VERSION
+
+    @retry_corrupt
+    def set_built(self):
+        self.connect().execute('PRAGMA user_version = %d' % BUILT_VERSION)
+
+
+thumbnail_index = ThumbnailIndex(settings.THUMBNAIL_INDEX_PATH,
+                                 os.path.join(settings.THUMBNAIL_DIR, GC_LOCK_FILE))
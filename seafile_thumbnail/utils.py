@@ -1,7 +1,9 @@
 import os
 import re
+import uuid
 import urllib.parse
 import posixpath
+from email.utils import parsedate_to_datetime
 from seafile_thumbnail.constants import TEXT, IMAGE, DOCUMENT, SPREADSHEET, SVG, PDF, MARKDOWN, VIDEO, \
     AUDIO, XMIND, SEADOC, TEXT_PREVIEW_EXT
 
@@ -10,7 +12,7 @@ from seaserv import seafile_api
 from seafile_thumbnail import settings
 
 PREVIEW_FILEEXT = {
-    IMAGE: ('gif', 'jpeg', 'jpg', 'png', 'ico', 'bmp', 'tif', 'tiff', 'psd', 'webp', 'jfif', 'heic'),
+    IMAGE: ('gif', 'jpeg', 'jpg', 'png', 'ico', 'bmp', 'tif', 'tiff', 'psd', 'webp', 'jfif', 'heic', 'heif'),
     DOCUMENT: ('doc', 'docx', 'docxf', 'oform', 'ppt', 'pptx', 'odt', 'fodt', 'odp', 'fodp', 'odg'),
     SPREADSHEET: ('xls', 'xlsx', 'ods', 'fods'),
     SVG: ('svg',),
@@ -102,19 +104,95 @@ def session_require(func):
 
 
 def cache_check(request, info):
+    """ Return True if the client's cached copy (If-None-Match /
+    If-Modified-Since) is still valid and a 304 can be returned.
+    """
     etag = info.get('etag')
     if_none_match_headers = request.headers.get('if-none-match')
-    if_none_match = if_none_match_headers[0] if if_none_match_headers else ''
+    if if_none_match_headers:
+        # If-None-Match takes precedence over If-Modified-Since, rfc 7232 6.
+        # weak comparison, a list of etags is allowed
+        if_none_match = ','.join(if_none_match_headers)
+        client_etags = [e.strip() for e in if_none_match.split(',')]
+        if '*' in client_etags:
+            return True
+        client_etags = [e[2:] if e.startswith('W/') else e for e in client_etags]
+        return etag in client_etags
 
     last_modified = info.get('last_modified')
     if_modified_since_headers = request.headers.get('if-modified-since')
     if_modified_since = if_modified_since_headers[0] if if_modified_since_headers else ''
-    if (if_none_match and if_none_match == etag) \
-            or (if_modified_since and if_modified_since == last_modified):
+    if not if_modified_since or not last_modified:
+        return False
+    if if_modified_since == last_modified:
         return True
-    else:
+    try:
+        return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
         return False
 
 
 def get_thumbnail_src(repo_id, size, path):
-    return posixpath.join("thumbnail", repo_id, str(size), path.lstrip('/'))
\ No newline at end of file
+    return posixpath.join("thumbnail", repo_id, str(size), path.lstrip('/'))
+
+
+def get_thumbnail_path(file_id, size, root=None):
+    # file_id is a sha1, its first bytes spread the thumbnails evenly over
+    # 65536 directories per size
+    return os.path.join(root or settings.THUMBNAIL_DIR, str(size), file_id[:2], file_id[2:4], file_id)
+
+
+def get_flat_thumbnail_path(thumbnail_path):
+    """ where the thumbnail at `thumbnail_path` was before the cache was sharded """
+    size_dir = os.path.dirname(os.path.dirname(os.path.dirname(thumbnail_path)))
+    return os.path.join(size_dir, os.path.basename(thumbnail_path))
+
+
+def migrate_flat_thumbnail(thumbnail_path):
+    """ move the thumbnail from the flat layout to `thumbnail_path`, return
+    False if there is none
+    """
+    if not settings.THUMBNAIL_MIGRATE_FLAT_LAYOUT:
+        return False
+    flat_path = get_flat_thumbnail_path(thumbnail_path)
+    try:
+        os.rename(flat_path, thumbnail_path)
+    except FileNotFoundError:
+        if not os.path.exists(flat_path):
+            return False
+        os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+        try:
+            os.rename(flat_path, thumbnail_path)
+        except FileNotFoundError:
+            # moved by another request meanwhile
+            return os.path.exists(thumbnail_path)
+    return True
+
+
+def thumbnail_exists(thumbnail_path):
+    return os.path.exists(thumbnail_path) or migrate_flat_thumbnail(thumbnail_path)
+
+
+def write_file_atomic(path, data, fsync=False):
+    """ Write `data` to a temporary file next to `path` and rename it over
+    `path`, so concurrent readers see either no file or the whole file.
+    With `fsync` the data is on the disk before it is renamed.
+    """
+    tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    try:
+        try:
+            f = open(tmp_path, 'wb')
+        except FileNotFoundError:
+            # the shard directory is made by the first thumbnail written to it
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            f = open(tmp_path, 'wb')
+        with f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
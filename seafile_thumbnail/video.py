@@ -0,0 +1,323 @@
+import re
+import time
+import logging
+import threading
+import subprocess
+import http.server
+from io import BytesIO
+
+import numpy
+from PIL import Image
+
+from seafile_thumbnail import settings
+from seafile_thumbnail.cache import InvalidFileError
+
+logger = logging.getLogger(__name__)
+
+PROXY_HEADERS = ('Content-Type', 'Content-Length', 'Content-Range', 'Accept-Ranges')
+RANGE_RE = re.compile(r'bytes=(\d+)-(\d*)$')
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+)$')
+DURATION_RE = re.compile(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)')
+# frames are scored on a small grayscale copy
+SCORE_SIZE = 64
+# frames darker or brighter than this are scored down
+EXPOSURE_MARGIN = 40.0
+# bytes of the windows read while probing kept for the following ffmpeg runs
+INDEX_CACHE_SIZE = 8 * 1024 ** 2
+
+
+def get_ffmpeg_binary():
+    # the ffmpeg binary moviepy is configured with
+    from moviepy.config import get_setting
+    return get_setting('FFMPEG_BINARY')
+
+
+class RangeProxy(object):
+    """ Serve one fileserver url to ffmpeg on a local port.
+
+    Range requests are forwarded in windows of THUMBNAIL_VIDEO_RANGE_WINDOW
+    bytes, so ffmpeg reads the index of the video and then only the bytes
+    around the frame it seeks to. Once `byte_budget` bytes were read from
+    the fileserver, responses are cut off.
+
+    While `caching` is set, the windows ffmpeg reads completely are kept,
+    so the header and index read when probing the video are not fetched
+    again by every ffmpeg run after it.
+    """
+    def __init__(self, client, url, byte_budget):
+        self.client = client
+        self.url = url
+        self.byte_budget = byte_budget
+        self.bytes_read = 0
+        self.over_budget = False
+        # ffmpeg failing then says nothing about the video
+        self.fileserver_failed = False
+        self.lock = threading.Lock()
+        self.caching = False
+        # window start -> bytes
+        self.windows = {}
+        self.cached_bytes = 0
+        self.size = None
+        self.content_type = None
+
+        proxy = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                proxy.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def local_url(self):
+        return 'http://127.0.0.1:%s/video' % self.server.server_address[1]
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def open_range(self, start, end):
+        """ fileserver response of bytes [start, end], None if it failed """
+        try:
+            return self.client.open(self.url, {'Range': 'bytes=%d-%d' % (start, end)})
+        except AssertionError as e:
+            logger.warning('Failed to read video from fileserver: %s' % (e,))
+            self.fileserver_failed = True
+            return None
+
+    def get_cached(self, start, end):
+        window = self.windows.get(start)
+        if window is None or len(window) < end - start + 1:
+            return None
+        return window[:end - start + 1]
+
+    def relay(self, response, request, start):
+        """ copy the body of `response` to `request`, False to stop """
+        chunks = [] if self.caching else None
+        try:
+            for chunk in response.iter_chunks():
+                with self.lock:
+                    self.bytes_read += len(chunk)
+                    if self.bytes_read > self.byte_budget:
+                        self.over_budget = True
+                if self.over_budget:
+                    return False
+                request.wfile.write(chunk)
+                if chunks is not None:
+                    chunks.append(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg seeked elsewhere and dropped this connection
+            return False
+
+        if chunks is not None:
+            window = b''.join(chunks)
+            with self.lock:
+                if self.cached_bytes + len(window) <= INDEX_CACHE_SIZE:
+                    self.windows[start] = window
+                    self.cached_bytes += len(window)
+        return True
+
+    def relay_window(self, request, start, end, response=None):
+        """ copy bytes [start, end] to `request`, False to stop """
+        cached = self.get_cached(start, end)
+        if cached is not None:
+            try:
+                request.wfile.write(cached)
+            except (BrokenPipeError, ConnectionResetError):
+                return False
+            return True
+
+        if response is None:
+            response = self.open_range(start, end)
+            if response is None:
+                return False
+        with response:
+            return response.status == 206 and self.relay(response, request, start)
+
+    def handle(self, request):
+        """ Answer a request of ffmpeg, usually an open ended `bytes=N-`.
+
+        The fileserver is asked for at most `window` bytes at a time and
+        the next window only once ffmpeg took the previous one, so the
+        read-ahead of a connection ffmpeg drops when it seeks stays small.
+        """
+        request.close_connection = True
+        if self.over_budget:
+            request.send_error(503)
+            return
+
+        window = settings.THUMBNAIL_VIDEO_RANGE_WINDOW
+        match = RANGE_RE.match(request.headers.get('Range', 'bytes=0-'))
+        if not match:
+            request.send_error(416)
+            return
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else None
+
+        response = None
+        first_end = start + window - 1 if end is None else min(end, start + window - 1)
+        if self.size is None or self.get_cached(start, min(first_end, self.size - 1)) is None:
+            response = self.open_range(start, first_end)
+            if response is None:
+                request.send_error(502)
+                return
+            content_range = CONTENT_RANGE_RE.match(response.getheader('Content-Range', ''))
+            if response.status != 206 or not content_range:
+                # the fileserver ignores Range, pass the whole file through
+                with response:
+                    request.send_response(response.status)
+                    for name in PROXY_HEADERS:
+                        value = response.getheader(name)
+                        if value:
+                            request.send_header(name, value)
+                    request.end_headers()
+                    self.relay(response, request, start)
+                return
+            self.size = int(content_range.group(3))
+            self.content_type = response.getheader('Content-Type', 'application/octet-stream')
+
+        last = self.size - 1 if end is None else min(end, self.size - 1)
+        request.send_response(206)
+        request.send_header('Content-Type', self.content_type)
+        request.send_header('Accept-Ranges', 'bytes')
+        request.send_header('Content-Range', 'bytes %d-%d/%d' % (start, last, self.size))
+        request.send_header('Content-Length', str(last - start + 1))
+        request.end_headers()
+
+        position = start
+        while position <= last:
+            window_end = min(last, position + window - 1)
+            if not self.relay_window(request, position, window_end, response):
+                return
+            response = None
+            position = window_end + 1
+
+
+def run_ffmpeg(proxy, args, timeout):
+    """ run ffmpeg on the video served by `proxy`, return the CompletedProcess """
+    cmd = [
+        get_ffmpeg_binary(), '-nostdin',
+        '-rw_timeout', str(int(max(timeout, 1) * 10 ** 6)),
+    ] + args
+    try:
+        return subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        logger.warning('Reading video takes more than %s seconds.' %
+                       settings.THUMBNAIL_VIDEO_TIME_BUDGET)
+        raise AssertionError(500, 'Video thumbnail time budget exceeded.')
+
+
+def get_video_duration(proxy, timeout):
+    """ duration of the video in seconds read from its index, or None """
+    # without output file ffmpeg only prints the input info and exits with 1
+    result = run_ffmpeg(proxy, ['-i', proxy.local_url], timeout)
+    match = DURATION_RE.search(result.stderr.decode(errors='replace'))
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def get_sample_times(duration):
+    """ times of the frames to try, best guess first """
+    frame_time = settings.THUMBNAIL_VIDEO_FRAME_TIME
+    if duration is None:
+        return [frame_time, 0]
+
+    # keep clear of the end, seeking there gives no frame
+    last = duration * 0.9
+    times = [min(frame_time, duration / 2)]
+    count = settings.THUMBNAIL_VIDEO_SAMPLE_FRAMES
+    for i in range(1, count):
+        times.append(min(last, duration * i / count))
+    return sorted(set(times), key=times.index)
+
+
+def extract_frame(proxy, frame_time, max_size, timeout):
+    """ BMP bytes of the keyframe at or before `frame_time`, or None """
+    result = run_ffmpeg(proxy, [
+        '-v', 'error',
+        # jump to the keyframe, do not decode up to the exact time
+        '-noaccurate_seek', '-ss', '%.3f' % frame_time,
+        '-i', proxy.local_url,
+        '-frames:v', '1',
+        '-vf', "scale='min(%d,iw)':'min(%d,ih)':force_original_aspect_ratio=decrease" % (
+            max_size, max_size),
+        '-f', 'image2pipe', '-vcodec', 'bmp', '-',
+    ], timeout)
+    if result.returncode != 0 or not result.stdout:
+        logger.info('No video frame at %ss: %s' % (frame_time, result.stderr.decode(errors='replace')))
+        return None
+    return result.stdout
+
+
+def score_frame(frame):
+    """ how much a frame shows, 0 for black, white or single colored frames """
+    image = Image.open(BytesIO(frame))
+    image.draft('L', (SCORE_SIZE, SCORE_SIZE))
+    image = image.convert('L')
+    image.thumbnail((SCORE_SIZE, SCORE_SIZE))
+    pixels = numpy.asarray(image, dtype=numpy.float32)
+    mean = pixels.mean()
+    # dark fade-ins and blown out frames are penalized by their luminance
+    exposure = min(1.0, mean / EXPOSURE_MARGIN, (255 - mean) / EXPOSURE_MARGIN)
+    return float(pixels.std() * max(exposure, 0.0))
+
+
+def extract_video_frame(client, url, max_size):
+    """ Return a representative frame of the video at `url` as BMP bytes,
+    fitted in `max_size` x `max_size`.
+
+    Keyframes at up to THUMBNAIL_VIDEO_SAMPLE_FRAMES times are tried, the
+    first one scoring THUMBNAIL_VIDEO_GOOD_FRAME_SCORE is taken, otherwise
+    the best of them. All of it shares THUMBNAIL_VIDEO_TIME_BUDGET seconds
+    and THUMBNAIL_VIDEO_BYTE_BUDGET bytes.
+    """
+    deadline = time.monotonic() + settings.THUMBNAIL_VIDEO_TIME_BUDGET
+    best_frame, best_score = None, -1
+    with RangeProxy(client, url, settings.THUMBNAIL_VIDEO_BYTE_BUDGET) as proxy:
+        try:
+            proxy.caching = True
+            duration = get_video_duration(proxy, deadline - time.monotonic())
+            proxy.caching = False
+            for frame_time in get_sample_times(duration):
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                frame = extract_frame(proxy, frame_time, max_size, timeout)
+                if proxy.over_budget:
+                    break
+                if frame is None:
+                    continue
+                score = score_frame(frame)
+                logger.debug('Video frame at %ss scores %.1f.' % (frame_time, score))
+                if score > best_score:
+                    best_frame, best_score = frame, score
+                if score >= settings.THUMBNAIL_VIDEO_GOOD_FRAME_SCORE:
+                    break
+        except AssertionError:
+            # out of time, but an earlier sample may do
+            if best_frame is None:
+                raise
+
+        logger.debug('Extract video frame reads %s bytes.' % proxy.bytes_read)
+        if best_frame is not None:
+            return best_frame
+        if proxy.fileserver_failed:
+            raise AssertionError(500, 'Internal server error.')
+        if proxy.over_budget:
+            logger.warning('Extracting video frame reads more than %s bytes.' %
+                           settings.THUMBNAIL_VIDEO_BYTE_BUDGET)
+            raise InvalidFileError(500, 'Video thumbnail byte budget exceeded.')
+        raise InvalidFileError(500, 'Failed to extract video frame.')